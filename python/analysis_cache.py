@@ -0,0 +1,102 @@
+import numpy as np
+import os
+import json
+import hashlib
+
+import analysis_util
+from tileutils.embedstore import is_store, META_FILE, VECTORS_FILE, NAMES_FILE
+
+
+def hash_update_array(h, arr):
+    arr = np.ascontiguousarray(arr)
+    h.update('{}{}'.format(arr.dtype, arr.shape).encode())
+    h.update(arr.data)
+
+
+class CachedStages:
+    """The analysis_util stages, with their results cached on disk and keyed by a hash of their input and parameters.
+
+    Each result is a single .npy file, <cache_dir>/<stage>/<key>.npy, memory-mapped when read back. As the key of
+    a stage covers the values of its input column, changing e.g. the embeddings changes the key of the PCA computed
+    from them, and of the KMeans computed from that, so only stages downstream of a change are rerun.
+    Without a cache_dir every stage is simply computed
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage, params, index, matrix=None, stats=None):
+        h = hashlib.sha1()
+        h.update(stage.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        h.update('\n'.join(str(x) for x in index).encode())
+        if matrix is not None:
+            hash_update_array(h, matrix)
+        if stats is not None:
+            h.update(json.dumps(stats).encode())
+        return h.hexdigest()
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key + '.npy')
+
+    def run(self, stage, key_fn, fn):
+        """Load the cached result of stage, or compute it with fn and cache it"""
+        if self.cache_dir is None:
+            return fn()
+        key = key_fn()
+        path = self.path(stage, key)
+        if os.path.exists(path):
+            self.hits += 1
+            print('{}: cached {}'.format(stage, key[:12]))
+            return np.load(path, mmap_mode='r')
+
+        self.misses += 1
+        # lists of per-row vectors become a 2-D array, lists of labels a 1-D one
+        result = np.array(list(fn()))
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # write then rename, an interrupted run never leaves a truncated result behind
+        np.save(path + '.tmp.npy', result)
+        os.replace(path + '.tmp.npy', path)
+        return result
+
+    def _run_column(self, stage, data, col_name, params, fn, init_col=None):
+        def key_fn():
+            matrix = analysis_util.get_matrix(data, col_name)
+            if init_col is not None:
+                # a stage started from another column depends on its values too
+                matrix = np.hstack([matrix, analysis_util.get_matrix(data, init_col)])
+            return self.key(stage, params, data.index, matrix)
+        return list(self.run(stage, key_fn, lambda: fn(data, col_name, **params)))
+
+    def get_embeddings(self, df, embeddings_dir):
+        def key_fn():
+            # the sizes and mtimes of the embedding files, like usemodel's incremental manifest
+            if is_store(embeddings_dir):
+                files = [META_FILE, VECTORS_FILE, NAMES_FILE]
+            else:
+                files = [name + '.npy' for name in df.index]
+            stats = []
+            for filename in files:
+                st = os.stat(os.path.join(embeddings_dir, filename))
+                stats.append((filename, st.st_size, st.st_mtime_ns))
+            return self.key('embeddings', {'embeddings_dir': os.path.abspath(embeddings_dir)}, df.index, stats=stats)
+        return list(self.run('embeddings', key_fn, lambda: analysis_util.get_embeddings(df, embeddings_dir)))
+
+    def get_tsne(self, data, col_name, perplexity=30, init='random', n_iter=3000, method='barnes_hut', warm_start=False):
+        params = {'perplexity': perplexity, 'init': init, 'n_iter': n_iter, 'method': method, 'warm_start': warm_start}
+        init_col = init if init not in ('random', 'pca') else None
+        return self._run_column('tsne', data, col_name, params, analysis_util.get_tsne, init_col)
+
+    def get_pca(self, data, col_name, n_components=10):
+        return self._run_column('pca', data, col_name, {'n_components': n_components}, analysis_util.get_pca)
+
+    def get_kmeans(self, data, col_name, n_clusters=10):
+        return self._run_column('kmeans', data, col_name, {'n_clusters': n_clusters}, analysis_util.get_kmeans)
+
+    def get_ward(self, data, col_name, n_cluster=10):
+        return self._run_column('ward', data, col_name, {'n_cluster': n_cluster}, analysis_util.get_ward)
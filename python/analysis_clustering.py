@@ -3,18 +3,17 @@ from ggplot import *
 from analysis_util import *
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import scale
-from sklearn.cluster import KMeans, AgglomerativeClustering
-from sklearn.metrics import adjusted_rand_score, silhouette_score, calinski_harabaz_score
+from analysis_sweep import sweep_kmeans, sweep_ward
+from analysis_compare import compare_clusterings
 
 
-data = pd.read_pickle('../data/analysis/result_all.pkl')
+data = read_df('../data/analysis/result_all.cols')
 
 # ==== tSNE =====
 
 for i in (5, 30, 100):
     for dataset in ('roads', 'buildings', 'rbw'):
-        d = data['tsne'+str(i)+'_'+dataset].apply(pd.Series)
-        d.columns = ['tsne_x', 'tsne_y']
+        d = pd.DataFrame(get_matrix(data, 'tsne'+str(i)+'_'+dataset), index=data.index, columns=['tsne_x', 'tsne_y'])
         d.to_csv('../data/analysis/'+dataset+'/tsne'+str(i)+'.csv')
 
 # ==== PCA ====
@@ -25,47 +24,31 @@ def analyse_pca(series):
     explained_ratios = pd.DataFrame({'explained_variance_ratio': pca.explained_variance_ratio_})
     return explained_ratios
     
-analyse_pca(data.e_roads).to_csv('../data/analysis/roads/pca_explained.csv')
-analyse_pca(data.e_buildings).to_csv('../data/analysis/buildings/pca_explained.csv')
-analyse_pca(data.e_rbw).to_csv('../data/analysis/rbw/pca_explained.csv')
+analyse_pca(get_matrix(data, 'e_roads')).to_csv('../data/analysis/roads/pca_explained.csv')
+analyse_pca(get_matrix(data, 'e_buildings')).to_csv('../data/analysis/buildings/pca_explained.csv')
+analyse_pca(get_matrix(data, 'e_rbw')).to_csv('../data/analysis/rbw/pca_explained.csv')
 
 
 # ==== KMEANS ====
 
-def analyse_kmeans(series):
-    pca = np.vstack(series)
-    Ks = range(2, 21)
-    km = [KMeans(n_clusters=i) for i in Ks]
-    fitted = [km[i].fit(pca) for i in range(len(km))] 
-    score = [fitted[i].score(pca) for i in range(len(km))]
-    explained = pd.DataFrame({'k': Ks, 'score': score})
-    explained.plot(0,1)
-    silh = [silhouette_score(pca, fitted[i].predict(pca)) for i in range(len(km))]
-    silhouette = pd.DataFrame({'k': Ks, 'silhouette_score': silh})
-    silhouette.plot(0,1)
-    return silhouette, explained
+# every (dataset, k) fit runs in a process pool, the fitted models are reused for the scores and the labels
+datasets = ('roads', 'buildings', 'rbw')
+Ks = range(2, 21)
+workers = os.cpu_count()
+# exact silhouette scores by default, set to e.g. 20000 to estimate them from a sample on large tile sets
+silhouette_sample_size = None
 
-sil_roads, elbow_roads = analyse_kmeans(data.pca_roads)
-elbow_roads.to_csv('../data/analysis/roads/kmeans_elbow.csv')
-sil_roads.to_csv('../data/analysis/roads/kmeans_silhouette.csv')
+kmeans_sweeps = sweep_kmeans({dataset: get_matrix(data, 'pca_'+dataset) for dataset in datasets}, Ks, workers, sample_size=silhouette_sample_size)
 
-sil_buildings,elbow_buildings = analyse_kmeans(data.pca_buildings)
-elbow_buildings.to_csv('../data/analysis/buildings/kmeans_elbow.csv')
-sil_buildings.to_csv('../data/analysis/buildings/kmeans_silhouette.csv')
-
-sil_rbw, elbow_rbw = analyse_kmeans(data.pca_rbw)
-elbow_rbw.to_csv('../data/analysis/rbw/kmeans_elbow.csv')
-sil_rbw.to_csv('../data/analysis/rbw/kmeans_silhouette.csv')
-
-
-for dataset in ('roads', 'buildings', 'rbw'):
+for dataset in datasets:
     print('dataset: ',dataset)
-    Ks = []
-    silhouette_list = []
-    calinski_harabaz_list = []
-    for k in range(2,21):
-        kmeans = get_kmeans(data, 'pca_'+dataset, k)
-        kmeans_df = pd.DataFrame({'cluster': kmeans}, index=data.index)
+    sweep = kmeans_sweeps[dataset]
+    sweep.scores.plot('k', 'score')
+    sweep.scores.plot('k', 'silhouette_score')
+    sweep.scores[['k', 'score']].to_csv('../data/analysis/'+dataset+'/kmeans_elbow.csv')
+    sweep.scores[['k', 'silhouette_score']].to_csv('../data/analysis/'+dataset+'/kmeans_silhouette.csv')
+    for k in Ks:
+        kmeans_df = sweep.labels_df(k, data.index)
         kmeans_df.to_csv('../data/analysis/'+dataset+'/kmeans'+str(k)+'.csv')
         print('K: ', k)
         print('clusters:', len(kmeans_df.cluster.unique()))
@@ -75,53 +58,49 @@ for dataset in ('roads', 'buildings', 'rbw'):
 
 # =========== WARD ===========
 
-for dataset in ('roads', 'buildings', 'rbw'):
+# one linkage tree per dataset, cut at every k
+ward_sweeps = sweep_ward({dataset: get_matrix(data, 'e_'+dataset) for dataset in datasets}, Ks, workers, sample_size=silhouette_sample_size)
+
+for dataset in datasets:
     print('dataset: ',dataset)
-    Ks = []
-    ward_silhouette = []
-    ward_calinski_harabaz = []
-    for k in range(2,21):
-        col_name = 'e_'+dataset
-        ward = get_ward(data, col_name, k)
-        ward_df = pd.DataFrame({'cluster': ward}, index=data.index)
+    sweep = ward_sweeps[dataset]
+    for k, silhouette, cal_har in sweep.scores[['k', 'silhouette_score', 'calinski_harabaz_score']].values:
+        k = int(k)
+        ward_df = sweep.labels_df(k, data.index)
         ward_df.to_csv('../data/analysis/'+dataset+'/e_ward'+str(k)+'.csv')
-        X = np.vstack(data[col_name])
-        silhouette = silhouette_score(X, ward_df.cluster)
-        cal_har = calinski_harabaz_score(X, ward_df.cluster)
-        Ks.append(k)
-        ward_silhouette.append(silhouette)
-        ward_calinski_harabaz.append(cal_har)
         print('K: ', k)
         print('cluster sizes:')
         print(ward_df.cluster.value_counts())
         print('silhouette score:',silhouette)
         print('calinski-harabasz score:', cal_har)
         print()
-    pd.DataFrame({'k': Ks, 'silhouette_score': ward_silhouette, 'calinski_harabaz_score': ward_calinski_harabaz}).to_csv('../data/analysis/e_ward_'+dataset+'_analysis.csv')
+    sweep.scores.to_csv('../data/analysis/e_ward_'+dataset+'_analysis.csv')
 
-# ============== Adjusted Rand Index
+# ============== Adjusted Rand Index, NMI and V-measure
 
+def get_comparison(comparison_df, models):
+    scores = compare_clusterings(comparison_df, ['cluster_'+model for model in models])
+    return {score: pd.DataFrame(m.values, index=models, columns=models) for score, m in scores.items()}
 
 def get_ari(comparison_df, models):
-    ari = pd.DataFrame(columns=models, index=models)
-    for i,model_a in enumerate(models):
-        for j, model_b in enumerate(models):
-            ari.at[model_a, model_b] = adjusted_rand_score(comparison_df['cluster_'+model_a].values, comparison_df['cluster_'+model_b])
-    return ari
+    return get_comparison(comparison_df, models)['ari']
     
 models = ('roads', 'buildings', 'rbw')
 
-kmeans2_comp = pd.read_csv('../data/analysis/kmeans/kmeans2_comparison.csv')
-km2ari = get_ari(kmeans2_comp, models)
-km2ari.to_csv('../data/analysis/kmeans/ari2.csv')
-
-kmeans10_comp = pd.read_csv('../data/analysis/kmeans/kmeans10_comparison.csv')
-km10ari = get_ari(kmeans10_comp, models)
-km10ari.to_csv('../data/analysis/kmeans/ari10.csv')
-
-kmeans20_comp = pd.read_csv('../data/analysis/kmeans/kmeans20_comparison.csv')
-km20ari = get_ari(kmeans2_comp, models)
-km20ari.to_csv('../data/analysis/kmeans/ari20.csv')
+for k in (2, 10, 20):
+    comparison = get_comparison(pd.read_csv('../data/analysis/kmeans/kmeans'+str(k)+'_comparison.csv'), models)
+    comparison['ari'].to_csv('../data/analysis/kmeans/ari'+str(k)+'.csv')
+    comparison['nmi'].to_csv('../data/analysis/kmeans/nmi'+str(k)+'.csv')
+    comparison['v_measure'].to_csv('../data/analysis/kmeans/v_measure'+str(k)+'.csv')
+
+# every kmeans and ward clustering of every model against each other
+all_clusterings = pd.DataFrame(index=data.index)
+for dataset in datasets:
+    for k in Ks:
+        all_clusterings['kmeans'+str(k)+'_'+dataset] = kmeans_sweeps[dataset].labels[k]
+        all_clusterings['e_ward'+str(k)+'_'+dataset] = ward_sweeps[dataset].labels[k]
+for score, comparison in compare_clusterings(all_clusterings, list(all_clusterings.columns), workers).items():
+    comparison.to_csv('../data/analysis/clusterings_'+score+'.csv')
 
 roads_kmeans2 = pd.read_csv('../data/analysis/roads/kmeans2.csv')
 buildings_kmeans2 = pd.read_csv('../data/analysis/buildings/kmeans2.csv')
@@ -0,0 +1,110 @@
+import numpy as np
+import os
+import time
+from itertools import combinations
+from multiprocessing import Pool
+
+import pandas as pd
+
+SCORES = ('ari', 'nmi', 'v_measure')
+
+# integer coded clusterings, set in every worker process by the pool initializer
+_codes = []
+
+
+def _init_worker(codes):
+    global _codes
+    _codes = codes
+
+
+def encode_labels(labels):
+    """Cluster labels of any type as integer codes 0..k-1"""
+    return np.unique(np.asarray(labels), return_inverse=True)[1].ravel()
+
+
+def contingency_table(a, b):
+    """(k_a, k_b) counts of rows in each pair of clusters of two integer coded clusterings"""
+    ka, kb = a.max() + 1, b.max() + 1
+    return np.bincount(a * kb + b, minlength=ka * kb).reshape(ka, kb)
+
+
+def _entropy(counts):
+    counts = counts[counts > 0]
+    total = counts.sum()
+    return -np.sum((counts / total) * (np.log(counts) - np.log(total)))
+
+
+def contingency_scores(table):
+    """Adjusted Rand index, normalised mutual information (arithmetic mean normalisation) and V-measure
+    of two clusterings, all from their contingency table. Same definitions and special cases as
+    sklearn.metrics' adjusted_rand_score, normalized_mutual_info_score and v_measure_score
+    """
+    n = int(table.sum())
+    rows, cols = table.sum(axis=1), table.sum(axis=0)
+
+    # pair confusion matrix, with python ints against overflow
+    sum_squares = int((table.astype(np.int64) ** 2).sum())
+    tp = sum_squares - n
+    fp = int(table.dot(cols).sum()) - sum_squares
+    fn = int(table.T.dot(rows).sum()) - sum_squares
+    tn = n * n - fp - fn - sum_squares
+    if fn == 0 and fp == 0:
+        ari = 1.0
+    else:
+        ari = 2.0 * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+    h_a, h_b = _entropy(rows), _entropy(cols)
+    if len(rows) == 1 or len(cols) == 1:
+        mi = 0.0
+    else:
+        i, j = np.nonzero(table)
+        nz = table[i, j].astype(np.float64)
+        mi = np.sum(nz / n * (np.log(nz) - np.log(n) - np.log(rows[i].astype(np.int64) * cols[j]) + 2 * np.log(n)))
+        mi = max(mi, 0.0)
+
+    if len(rows) == len(cols) == 1:
+        nmi = 1.0
+    elif mi == 0:
+        nmi = 0.0
+    else:
+        nmi = mi / ((h_a + h_b) / 2)
+
+    homogeneity = mi / h_a if h_a else 1.0
+    completeness = mi / h_b if h_b else 1.0
+    v_measure = 0.0 if homogeneity + completeness == 0 else 2 * homogeneity * completeness / (homogeneity + completeness)
+    return float(ari), float(nmi), float(v_measure)
+
+
+def _compare_pairs(pairs):
+    return [(i, j, contingency_scores(contingency_table(_codes[i], _codes[j]))) for i, j in pairs]
+
+
+def compare_clusterings(data, cluster_columns, workers=os.cpu_count(), pairs_per_job=16):
+    """ARI, NMI and V-measure of every pair of clustering columns, as a dict of symmetric DataFrames.
+
+    The labels are integer coded once, and only the upper triangle is computed, one contingency table
+    per pair, in a pool of worker processes. All three scores are symmetric and 1 on the diagonal
+    """
+    start = time.time()
+    codes = [encode_labels(data[c]) for c in cluster_columns]
+    pairs = list(combinations(range(len(codes)), 2))
+    jobs = [pairs[i:i + pairs_per_job] for i in range(0, len(pairs), pairs_per_job)]
+
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)), _init_worker, (codes,))
+        try:
+            results = pool.map(_compare_pairs, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(codes)
+        results = list(map(_compare_pairs, jobs))
+
+    k = len(codes)
+    matrices = {score: np.eye(k) for score in SCORES}
+    for i, j, scores in (result for job in results for result in job):
+        for score, value in zip(SCORES, scores):
+            matrices[score][i, j] = matrices[score][j, i] = value
+    print('compared {} pairs of clusterings in {:.1f}s'.format(len(pairs), time.time() - start))
+    return {score: pd.DataFrame(m, index=cluster_columns, columns=cluster_columns) for score, m in matrices.items()}
@@ -0,0 +1,228 @@
+import numpy as np
+import os
+import json
+import time
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from analysis_knn import IVFIndex, squared_distances
+from tileutils.embedstore import EmbeddingStore, EmbeddingWriter, is_store, tile_name
+
+MAIN_DIR = 'main'
+ADDED_DIR = 'added'
+NAMES_FILE = 'names.txt'
+
+
+class TileIndex:
+    """Persistent nearest neighbour index over tile embeddings.
+
+    The bulk of the tiles sit in a memory-mapped IVF index, tiles added later go to an append-only
+    embedding store which is scanned exhaustively, until compact() moves them into the IVF lists
+    (reusing the trained quantizer, so no rebuild is needed). Tiles added again replace their old vector
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.ivf = IVFIndex.load(os.path.join(index_dir, MAIN_DIR))
+        with open(os.path.join(index_dir, NAMES_FILE)) as f:
+            self.names = np.array(f.read().splitlines())
+        # row of each id in the list-sorted vectors
+        self.positions = np.empty(len(self.ivf.ids), dtype=np.int64)
+        self.positions[self.ivf.ids] = np.arange(len(self.ivf.ids))
+        self.name_ids = {name: i for i, name in enumerate(self.names)}
+        self._load_added()
+
+    def _load_added(self):
+        added_dir = os.path.join(self.index_dir, ADDED_DIR)
+        self.added = EmbeddingStore(added_dir) if is_store(added_dir) else None
+        added_names = self.added.index if self.added is not None else {}
+        self.superseded = np.array([name in added_names for name in self.names], dtype=bool)
+        self.n_superseded = int(self.superseded.sum())
+        if self.added is not None:
+            self.added_rows = np.array(sorted(self.added.index.values()), dtype=np.int64)
+            self.added_vectors = np.asarray(self.added.vectors[self.added_rows])
+            self.added_sq_norms = np.einsum('ij,ij->i', self.added_vectors, self.added_vectors)
+            self.added_names = np.array(self.added.names)[self.added_rows]
+
+    @classmethod
+    def build(cls, names, X, index_dir, nlist=1024, nprobe=16):
+        X = np.asarray(X, dtype=np.float32)
+        start = time.time()
+        IVFIndex(nlist, nprobe).fit(X).save(os.path.join(index_dir, MAIN_DIR))
+        with open(os.path.join(index_dir, NAMES_FILE), 'w') as f:
+            f.writelines(name + '\n' for name in names)
+        print('built index of {} tiles in {:.1f}s'.format(len(X), time.time() - start))
+        return cls(index_dir)
+
+    def __len__(self):
+        n_added = len(self.added_rows) if self.added is not None else 0
+        return len(self.names) - self.n_superseded + n_added
+
+    def __contains__(self, name):
+        return name in self.name_ids or (self.added is not None and name in self.added)
+
+    def vector(self, name):
+        if self.added is not None and name in self.added:
+            return np.asarray(self.added.get(name))
+        return np.asarray(self.ivf.vectors[self.positions[self.name_ids[name]]])
+
+    def add(self, names, vectors):
+        """Add or replace tiles, they can be queried right away"""
+        with EmbeddingWriter(os.path.join(self.index_dir, ADDED_DIR), dim=self.ivf.vectors.shape[1]) as writer:
+            writer.append(names, vectors)
+        self._load_added()
+
+    def query_vector(self, vector, k=5, nprobe=None, exclude=None):
+        """k nearest tiles to a vector, e.g. one produced by usemodel.Encoder, as (names, distances)"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        # ask for a few more to make up for superseded and excluded tiles
+        distances, ids = self.ivf.search(vector, k + 1 + (k if self.n_superseded else 0), nprobe, return_distance=True)
+        ids, distances = ids[0], distances[0]
+        keep = (ids >= 0)
+        keep[keep] = ~self.superseded[ids[keep]]
+        names, distances = self.names[ids[keep]], distances[keep]
+
+        if self.added is not None and len(self.added_rows):
+            added_distances = np.sqrt(squared_distances(vector, self.added_vectors, self.added_sq_norms)[0])
+            kk = min(k + 1, len(added_distances))
+            best = np.argpartition(added_distances, kk - 1)[:kk]
+            names = np.concatenate([names, self.added_names[best]])
+            distances = np.concatenate([distances, added_distances[best]])
+
+        order = np.argsort(distances, kind='stable')
+        result = [(str(names[i]), float(distances[i])) for i in order if names[i] != exclude][:k]
+        return [name for name, _ in result], [d for _, d in result]
+
+    def query_name(self, name, k=5, nprobe=None):
+        """k nearest tiles to a tile in the index, not counting the tile itself"""
+        return self.query_vector(self.vector(tile_name(name)), k, nprobe, exclude=tile_name(name))
+
+    def compact(self):
+        """Move the added tiles into the IVF lists, keeping the trained quantizer"""
+        if self.added is None:
+            return
+        keep = np.flatnonzero(~self.superseded)
+        X = np.vstack([np.asarray(self.ivf.vectors)[self.positions[keep]], self.added_vectors])
+        names = list(self.names[keep]) + list(self.added_names)
+
+        ivf = IVFIndex.load(os.path.join(self.index_dir, MAIN_DIR), mmap_mode=None)
+        ivf._set_vectors(X, np.arange(len(X)))
+        ivf.save(os.path.join(self.index_dir, MAIN_DIR))
+        with open(os.path.join(self.index_dir, NAMES_FILE), 'w') as f:
+            f.writelines(name + '\n' for name in names)
+        added_dir = os.path.join(self.index_dir, ADDED_DIR)
+        for filename in os.listdir(added_dir):
+            os.remove(os.path.join(added_dir, filename))
+        os.rmdir(added_dir)
+        self.__init__(self.index_dir)
+
+
+def serve(index, port=8765):
+    """Minimal JSON API keeping the index loaded:
+
+    GET /neighbours?name=15_16620_11260&k=5
+    POST /neighbours with {"vector": [...], "k": 5}
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _query(self, fn, *args):
+            start = time.time()
+            try:
+                names, distances = fn(*args)
+            except KeyError as e:
+                return self._reply(404, {'error': 'unknown tile {}'.format(e)})
+            self._reply(200, {'names': names, 'distances': distances, 'elapsed_ms': (time.time() - start) * 1000})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path != '/neighbours' or 'name' not in params:
+                return self._reply(400, {'error': 'expected /neighbours?name=...'})
+            self._query(index.query_name, params['name'][0], int(params.get('k', [5])[0]))
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self._query(index.query_vector, body['vector'], int(body.get('k', 5)))
+
+    print('serving {} tiles on port {}'.format(len(index), port))
+    HTTPServer(('localhost', port), Handler).serve_forever()
+
+
+def encode_tile(model_name, png_path):
+    from tileutils import usemodel
+    enc_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'data', 'models', 'vaegan', model_name, 'saved_model_image_in', '1')
+    return usemodel.Encoder(enc_dir).encode(usemodel.read_img_bytes(png_path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('embed_dir')
+    build_parser.add_argument('index_dir')
+    build_parser.add_argument('--nlist', type=int, default=1024)
+    build_parser.add_argument('--nprobe', type=int, default=16)
+
+    add_parser = subparsers.add_parser('add')
+    add_parser.add_argument('index_dir')
+    add_parser.add_argument('embed_dir')
+
+    compact_parser = subparsers.add_parser('compact')
+    compact_parser.add_argument('index_dir')
+
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('index_dir')
+    query_parser.add_argument('name', nargs='?')
+    query_parser.add_argument('--image')
+    query_parser.add_argument('--model')
+    query_parser.add_argument('-k', type=int, default=5)
+    query_parser.add_argument('--nprobe', type=int)
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('index_dir')
+    serve_parser.add_argument('--port', type=int, default=8765)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        store = EmbeddingStore(args.embed_dir)
+        # a re-appended tile is in the store more than once, only its latest row goes in the index
+        names = sorted(store.index, key=store.index.get)
+        TileIndex.build(names, store.vectors[store.rows(names)], args.index_dir, args.nlist, args.nprobe)
+    elif args.command == 'add':
+        index = TileIndex(args.index_dir)
+        store = EmbeddingStore(args.embed_dir)
+        names = sorted(store.index, key=store.index.get)
+        vectors = np.asarray(store.vectors[store.rows(names)])
+        # new tiles, and tiles whose embedding changed, which supersede their old entry
+        changed = [i for i, name in enumerate(names) if name not in index or not np.array_equal(index.vector(name), vectors[i])]
+        n_new = sum(names[i] not in index for i in changed)
+        index.add([names[i] for i in changed], vectors[changed])
+        print('added {} tiles, replaced {}'.format(n_new, len(changed) - n_new))
+    elif args.command == 'compact':
+        TileIndex(args.index_dir).compact()
+    elif args.command == 'query':
+        index = TileIndex(args.index_dir)
+        start = time.time()
+        if args.image:
+            names, distances = index.query_vector(encode_tile(args.model, args.image), args.k, args.nprobe)
+        else:
+            names, distances = index.query_name(args.name, args.k, args.nprobe)
+        elapsed = time.time() - start
+        for name, distance in zip(names, distances):
+            print(name, distance)
+        print('elapsed {:.2f}ms'.format(elapsed * 1000))
+    elif args.command == 'serve':
+        serve(TileIndex(args.index_dir), args.port)
@@ -0,0 +1,205 @@
+import numpy as np
+import os
+import json
+import time
+import argparse
+
+from sklearn.neighbors import NearestNeighbors
+from sklearn.cluster import KMeans
+
+
+def squared_distances(a, b, b_sq_norms=None):
+    if b_sq_norms is None:
+        b_sq_norms = np.einsum('ij,ij->i', b, b)
+    d = np.einsum('ij,ij->i', a, a)[:, np.newaxis] - 2 * a.dot(b.T) + b_sq_norms[np.newaxis, :]
+    return np.maximum(d, 0, out=d)
+
+
+def exact_knn(X, k, queries=None, chunk_size=4096):
+    """Indices of the k nearest neighbours of every query row (default: every row of X), in batched chunks"""
+    queries = X if queries is None else queries
+    neigh = NearestNeighbors(n_neighbors=k, algorithm='brute').fit(X)
+    return np.vstack([neigh.kneighbors(queries[i:i + chunk_size], return_distance=False)
+                      for i in range(0, len(queries), chunk_size)])
+
+
+IVF_ARRAYS = ('centroids', 'vectors', 'ids', 'sq_norms', 'offsets')
+
+
+class IVFIndex:
+    """Inverted file index for approximate nearest neighbour search.
+
+    The vectors are partitioned by a coarse k-means quantizer into nlist lists, stored contiguously
+    per list. A query only scans the nprobe lists whose centroids are closest to it
+    """
+
+    def __init__(self, nlist=256, nprobe=8, sample_size=100000, random_state=1234):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.sample_size = sample_size
+        self.random_state = random_state
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        rng = np.random.RandomState(self.random_state)
+        sample = X[rng.choice(len(X), self.sample_size, replace=False)] if len(X) > self.sample_size else X
+        self.centroids = KMeans(n_clusters=min(self.nlist, len(sample)), n_init=1, max_iter=20,
+                                random_state=self.random_state).fit(sample).cluster_centers_.astype(np.float32)
+        self._set_vectors(X, np.arange(len(X)))
+        return self
+
+    def assign(self, X, chunk_size=4096):
+        return np.concatenate([squared_distances(X[i:i + chunk_size], self.centroids).argmin(axis=1)
+                               for i in range(0, len(X), chunk_size)])
+
+    def _set_vectors(self, X, ids):
+        lists = self.assign(X)
+        order = np.argsort(lists, kind='stable')
+        self.vectors = X[order]
+        self.ids = ids[order]
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.offsets = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+
+    def save(self, index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            pass
+        for name in IVF_ARRAYS:
+            # replace rather than overwrite, the old arrays may still be memory-mapped
+            path = os.path.join(index_dir, name + '.npy')
+            np.save(path + '.tmp.npy', getattr(self, name))
+            os.replace(path + '.tmp.npy', path)
+        with open(os.path.join(index_dir, 'ivf.json'), 'w') as f:
+            json.dump({'nlist': self.nlist, 'nprobe': self.nprobe, 'sample_size': self.sample_size,
+                       'random_state': self.random_state}, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        """Load a saved index, memory-mapping the vectors so that only the probed lists are read"""
+        with open(os.path.join(index_dir, 'ivf.json')) as f:
+            index = cls(**json.load(f))
+        for name in IVF_ARRAYS:
+            setattr(index, name, np.load(os.path.join(index_dir, name + '.npy'), mmap_mode=mmap_mode))
+        return index
+
+    def search(self, queries, k, nprobe=None, chunk_size=1024, return_distance=False):
+        """k approximate nearest neighbours of each query, as ids into the fitted matrix (-1 where fewer were found)"""
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        results = [self._search_chunk(queries[i:i + chunk_size], k, nprobe) for i in range(0, len(queries), chunk_size)]
+        ids = np.vstack([r[0] for r in results])
+        if return_distance:
+            return np.sqrt(np.vstack([r[1] for r in results])), ids
+        return ids
+
+    def _search_chunk(self, queries, k, nprobe):
+        m = len(queries)
+        probes = np.argpartition(squared_distances(queries, self.centroids), nprobe - 1, axis=1)[:, :nprobe]
+
+        # candidates per query: the best k of each probed list, in slot (query, probe)
+        best_d = np.full((m, nprobe, k), np.inf, dtype=np.float32)
+        best_i = np.full((m, nprobe, k), -1, dtype=np.int64)
+
+        # group the (query, probe) pairs by list, so that each list is scanned once for all its queries
+        flat = probes.ravel()
+        order = np.argsort(flat, kind='stable')
+        lists, starts = np.unique(flat[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for l, start, end in zip(lists, starts, ends):
+            lo, hi = self.offsets[l], self.offsets[l + 1]
+            if lo == hi:
+                continue
+            query_rows, slots = np.divmod(order[start:end], nprobe)
+            d = squared_distances(queries[query_rows], self.vectors[lo:hi], self.sq_norms[lo:hi])
+            kk = min(k, hi - lo)
+            part = np.argpartition(d, kk - 1, axis=1)[:, :kk]
+            best_d[query_rows, slots, :kk] = np.take_along_axis(d, part, axis=1)
+            best_i[query_rows, slots, :kk] = self.ids[lo + part]
+
+        best_d = best_d.reshape(m, -1)
+        best_i = best_i.reshape(m, -1)
+        top = np.argsort(best_d, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(best_i, top, axis=1), np.take_along_axis(best_d, top, axis=1)
+
+
+def approximate_knn(X, k, queries=None, nlist=256, nprobe=8, chunk_size=1024):
+    """k approximate nearest neighbours of every query row. Queries whose probed lists hold fewer than k
+    vectors are searched again with twice as many lists, until they get k or all lists are probed
+    """
+    queries = X if queries is None else queries
+    index = IVFIndex(nlist, nprobe).fit(X)
+    nn = index.search(queries, k, chunk_size=chunk_size)
+    short = np.flatnonzero((nn < 0).any(axis=1))
+    while len(short) and nprobe < len(index.centroids):
+        nprobe = min(nprobe * 2, len(index.centroids))
+        nn[short] = index.search(np.asarray(queries)[short], k, nprobe, chunk_size)
+        short = short[(nn[short] < 0).any(axis=1)]
+    return nn
+
+
+def without_self(nn, k):
+    """The first k neighbours of every row other than the row itself, and without -1 padding, as a list of
+    arrays, shorter where fewer were found. The query is not always first, e.g. with duplicates or IVF search
+    """
+    return [row[(row != i) & (row >= 0)][:k] for i, row in enumerate(nn)]
+
+
+def recall(approx, exact):
+    """Fraction of the exact neighbours found by the approximate search"""
+    return np.mean([len(np.intersect1d(a, e)) / float(len(e)) for a, e in zip(approx, exact)])
+
+
+def benchmark_knn(X, k=5, nlist=256, nprobes=(1, 2, 4, 8, 16, 32), n_rowwise=1000):
+    X = np.asarray(X, dtype=np.float32)
+    print('{} vectors of dimension {}, k={}'.format(X.shape[0], X.shape[1], k))
+
+    neigh = NearestNeighbors(n_neighbors=k + 1).fit(X)
+    sample = X[:n_rowwise]
+    start = time.time()
+    for row in sample:
+        neigh.kneighbors(row.reshape(1, -1), return_distance=False)
+    rowwise = (time.time() - start) / len(sample)
+    print('exact, one query per row: {:.3f}ms per query'.format(rowwise * 1000))
+
+    start = time.time()
+    exact = exact_knn(X, k + 1)
+    elapsed = time.time() - start
+    print('exact, batched:           {:.3f}ms per query ({:.1f}s total)'.format(elapsed * 1000 / len(X), elapsed))
+
+    start = time.time()
+    index = IVFIndex(nlist).fit(X)
+    print('IVF build with {} lists:  {:.1f}s'.format(nlist, time.time() - start))
+
+    results = []
+    for nprobe in nprobes:
+        start = time.time()
+        approx = index.search(X, k + 1, nprobe)
+        elapsed = time.time() - start
+        r = recall(approx, exact)
+        results.append((nprobe, elapsed * 1000 / len(X), r))
+        print('IVF nprobe={:<3}           {:.3f}ms per query, recall@{} {:.3f}'.format(nprobe, elapsed * 1000 / len(X), k + 1, r))
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embed-dir')
+    parser.add_argument('--random', type=int, nargs=2, metavar=('N', 'D'), default=(100000, 100))
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    if args.embed_dir:
+        from tileutils.embedstore import EmbeddingStore
+        X = EmbeddingStore(args.embed_dir).matrix()
+    else:
+        n, d = args.random
+        # clustered synthetic data, uniform noise makes every ANN method look bad
+        rng = np.random.RandomState(1234)
+        centers = rng.randn(1000, d)
+        X = centers[rng.randint(1000, size=n)] + rng.randn(n, d)
+
+    benchmark_knn(X, args.k, args.nlist, args.nprobe)
@@ -1,43 +1,50 @@
 from analysis_util import *
+from analysis_cache import CachedStages
+
+# every stage is cached in ../data/analysis/cache, keyed by its input and parameters, so a rerun only
+# recomputes what changed
+stages = CachedStages('../data/analysis/cache')
+
+n_principal_components = 10
+# 'fft' is much faster on large tile sets, it needs openTSNE
+tsne_method = 'barnes_hut'
 
 
 def preprocess(data, name):
     e_name = 'e_' + name
-    data[e_name] = get_embeddings(data, '../data/embeds/france_15_'+name+'_128_full')
-
-    for perplexity in [5, 30, 100]:
+    pca_name = 'pca_' + name
+    data[e_name] = stages.get_embeddings(data, '../data/embeds/france_15_'+name+'_128_full')
+    data[pca_name] = stages.get_pca(data, e_name, n_principal_components)
+
+    # perplexity 30 starts from the principal components, 5 and 100 are warm started from its layout
+    base_name = 'tsne30_' + name
+    data[base_name] = stages.get_tsne(data, e_name, 30, init=pca_name, n_iter=1000, method=tsne_method)
+    for perplexity in [5, 100]:
         tsne_name = 'tsne' + str(perplexity) + '_' + name
-        data[tsne_name] = get_tsne(data, e_name, perplexity)
-    
+        data[tsne_name] = stages.get_tsne(data, e_name, perplexity, init=base_name, n_iter=750, method=tsne_method, warm_start=True)
+
 
 if __name__ == '__main__':
 
     data_csv = '../data/analysis/matched-ghs-fr-core.csv'
     data = get_df_from_csv(data_csv)
-    
+
     for name in ['roads', 'buildings', 'rbw']:
         preprocess(data, name)
 
-    data['e_roads'] = get_embeddings(data, '../data/embeds/france_15_roads_128_full')
-    data['e_buildings'] = get_embeddings(data, '../data/embeds/france_15_buildings_128_full')
-    data['e_rbw'] = get_embeddings(data, '../data/embeds/france_15_rbw_128_full')
-
+    # same embeddings and perplexity as computed by preprocess
     tsne_perplexity = 30
-    data['tsne_roads'] = get_tsne(data, 'e_roads', tsne_perplexity)
-    data['tsne_buildings'] = get_tsne(data, 'e_buildings', tsne_perplexity)
-    data['tsne_rbw'] = get_tsne(data, 'e_rbw', tsne_perplexity)
-    
-    write_df(data, '../data/analysis/embed_tsne_all.pkl')
-
-    n_principal_components = 10
-    data['pca_roads'] = get_pca(data, 'e_roads', n_principal_components)
-    data['pca_buildings'] = get_pca(data, 'e_buildings', n_principal_components)
-    data['pca_rbw'] = get_pca(data, 'e_rbw', n_principal_components)
-
-    data['kmeans3_roads'] = get_kmeans(data, 'pca_roads', 3)
-    data['kmeans3_buildings'] = get_kmeans(data, 'pca_buildings', 3)
-    data['kmeans3_rbw'] = get_kmeans(data, 'pca_rbw', 3)
-    
+    data['tsne_roads'] = data['tsne'+str(tsne_perplexity)+'_roads']
+    data['tsne_buildings'] = data['tsne'+str(tsne_perplexity)+'_buildings']
+    data['tsne_rbw'] = data['tsne'+str(tsne_perplexity)+'_rbw']
+
+    write_df(data, '../data/analysis/embed_tsne_all.cols')
+
+    data['kmeans3_roads'] = stages.get_kmeans(data, 'pca_roads', 3)
+    data['kmeans3_buildings'] = stages.get_kmeans(data, 'pca_buildings', 3)
+    data['kmeans3_rbw'] = stages.get_kmeans(data, 'pca_rbw', 3)
+
     print(data)
+    print('{} stages computed, {} loaded from cache'.format(stages.misses, stages.hits))
 
-    write_df(data, '../data/analysis/result_all.pkl')
\ No newline at end of file
+    write_df(data, '../data/analysis/result_all.cols')
@@ -1,17 +1,85 @@
 from scipy.stats import mannwhitneyu
+from scipy.special import ndtr
+from multiprocessing import Pool
+import numpy as np
+import os
 import pandas as pd
 
 
+def mann_whitney_matrix(values, labels, alternative='less', use_continuity=True):
+    """U statistics and p-values of mannwhitneyu(values[labels == a], values[labels == b], alternative)
+    for every ordered pair of clusters (a, b), as two (k, k) arrays and the sorted cluster labels.
+
+    The values are ranked once for the whole clustering: with the count of each cluster at each distinct value,
+    the U statistic of every pair is a single matrix product, and the tie correction terms come from the same
+    counts. Gives the same results as scipy, whose 'auto' method is also followed for pairs small enough
+    to get an exact p-value
+    """
+    values = np.asarray(values, dtype=np.float64)
+    clusters, codes = np.unique(labels, return_inverse=True)
+    codes = codes.ravel()
+    k = len(clusters)
+
+    # nan propagates to every comparison involving its cluster, as in scipy
+    nan = np.isnan(values)
+    nan_clusters = np.unique(codes[nan])
+    distinct, value_codes = np.unique(values[~nan], return_inverse=True)
+    m = len(distinct)
+    counts = np.bincount(codes[~nan] * m + value_codes.ravel(), minlength=k * m).reshape(k, m).astype(np.float64)
+
+    below = np.cumsum(counts, axis=1) - counts
+    U1 = counts.dot((below + 0.5 * counts).T)
+    n1 = counts.sum(axis=1)[:, np.newaxis]
+    n2 = n1.T
+    U2 = n1 * n2 - U1
+    if alternative == 'greater':
+        U, f = U1, 1
+    elif alternative == 'less':
+        U, f = U2, 1
+    else:
+        U, f = np.maximum(U1, U2), 2
+
+    # sum of t^3 - t over the tie groups of each pooled pair, t = counts[a] + counts[b]
+    cubes = (counts ** 3).sum(axis=1)[:, np.newaxis]
+    squares = counts ** 2
+    tie_term = cubes + cubes.T + 3 * squares.dot(counts.T) + 3 * counts.dot(squares.T) - n1 - n2
+
+    # same operations as scipy's asymptotic method, for identical results
+    mu = n1 * n2 / 2
+    n = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1*n2/12 * ((n + 1) - tie_term/(n*(n-1))))
+        numerator = U - mu
+        if use_continuity:
+            numerator -= 0.5
+        z = numerator / s
+    p = np.clip(ndtr(-z) * f, 0., 1.)
+
+    # scipy's exact method for pairs with a cluster of 8 or fewer and no ties
+    ties = tie_term > 0
+    small = (np.minimum(n1, n2) <= 8) & ~ties
+    for a, b in zip(*np.nonzero(small)):
+        p[a, b] = mannwhitneyu(values[codes == a], values[codes == b], use_continuity, alternative).pvalue
+
+    U1[nan_clusters, :] = U1[:, nan_clusters] = np.nan
+    p[nan_clusters, :] = p[:, nan_clusters] = np.nan
+    return U1, p, clusters
+
+
 data = pd.read_csv('../data/analysis/matched-ghs-fr-core.csv')
+data['normdist'] = data.distance_from_center / data.city_max_dist
 
 def get_mann_whitney(df,dataset, k, alpha=0.05):
     kmeans = pd.read_csv('../data/analysis/'+dataset+'/kmeans'+str(k)+'.csv')
     m = df.merge(kmeans, on='name')
-    m['normdist'] = m.distance_from_center / m.city_max_dist
-    clusters = sorted(m.cluster.unique())
-    res= [mannwhitneyu(m[m.cluster==c1]['normdist'].values, m[m.cluster==c2]['normdist'].values, alternative='less') for c1 in clusters for c2 in clusters]
-    return pd.DataFrame(np.array([str(r.statistic)+'*' if r.pvalue < alpha else str(r.statistic) for r in res]).reshape(k,k), columns=clusters, index=clusters)
-    
+    statistics, pvalues, clusters = mann_whitney_matrix(m.normdist.values, m.cluster.values, alternative='less')
+    flags = np.where(pvalues < alpha, '*', '')
+    return pd.DataFrame(np.array([str(s)+f for s, f in zip(statistics.ravel(), flags.ravel())]).reshape(k,k), columns=clusters, index=clusters)
+
+def _mann_whitney_job(job):
+    dataset, k = job
+    return dataset, k, get_mann_whitney(data, dataset, k)
+
 def compare_mann_whitney(data, k):
     print('R2')
     print (get_mann_whitney(data, 'roads',k))
@@ -21,10 +89,19 @@ def compare_mann_whitney(data, k):
     print(get_mann_whitney(data, 'rbw',k))
 
 
-for i in range(2,20):
-    r=get_mann_whitney(data, 'roads',i)
-    b=get_mann_whitney(data, 'buildings',i)
-    rbw=get_mann_whitney(data, 'rbw',i)
-    pd.concat({'R2':r, 'B2':b, 'RBW2':rbw}, axis=1, names=['model', 'cluster']).to_csv('../data/analysis/mann_whitney/mann_whitney'+str(i)+'.csv')
-    
-compare_mann_whitney(data,5)
\ No newline at end of file
+if __name__ == '__main__':
+
+    # every (model, k) is independent, spread them over a pool of worker processes
+    models = {'roads': 'R2', 'buildings': 'B2', 'rbw': 'RBW2'}
+    jobs = [(dataset, i) for i in range(2,20) for dataset in models]
+    pool = Pool(os.cpu_count())
+    try:
+        results = {(dataset, k): result for dataset, k, result in pool.imap_unordered(_mann_whitney_job, jobs)}
+    finally:
+        pool.close()
+        pool.join()
+
+    for i in range(2,20):
+        pd.concat({models[dataset]: results[(dataset, i)] for dataset in models}, axis=1, names=['model', 'cluster']).to_csv('../data/analysis/mann_whitney/mann_whitney'+str(i)+'.csv')
+
+    compare_mann_whitney(data,5)
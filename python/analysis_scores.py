@@ -0,0 +1,143 @@
+import numpy as np
+import time
+import argparse
+
+from scipy import sparse
+from scipy.stats import norm
+from sklearn.metrics import calinski_harabaz_score
+
+from analysis_knn import squared_distances
+
+
+class Labelings:
+    """Several clusterings of the same N rows, e.g. KMeans for k=2..20, as one sparse (N, sum of k) indicator matrix.
+
+    Multiplying a block of distances by it gives the distance sums from each row of the block to every cluster
+    of every clustering in one pass, so a distance block is computed once and shared by all clusterings
+    """
+
+    def __init__(self, labelings):
+        self.codes = []
+        self.counts = []
+        self.offsets = [0]
+        columns = []
+        for labels in labelings:
+            clusters, codes = np.unique(np.asarray(labels), return_inverse=True)
+            self.codes.append(codes.ravel())
+            self.counts.append(np.bincount(codes.ravel()))
+            columns.append(codes.ravel() + self.offsets[-1])
+            self.offsets.append(self.offsets[-1] + len(clusters))
+        n = len(self.codes[0])
+        rows = np.tile(np.arange(n), len(columns))
+        self.indicator = sparse.csr_matrix((np.ones(len(rows)), (rows, np.concatenate(columns))), shape=(n, self.offsets[-1]))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def cluster_sums(self, block):
+        """(len(block), sum of k) sums of the block's columns over the members of each cluster"""
+        return np.asarray(self.indicator.T.dot(block.T).T)
+
+
+def block_rows(n, block_bytes=1 << 28):
+    """Rows per distance block, so that a block against all n rows stays within block_bytes"""
+    return max(1, block_bytes // (8 * n))
+
+
+def silhouette_samples(X, labelings, rows, X_sq_norms=None, block_bytes=1 << 28):
+    """(len(labelings), len(rows)) silhouette coefficients of the given rows of X, for every clustering.
+
+    The distances are computed one block of rows at a time, so memory stays within about block_bytes
+    whatever the size of X. Rows in singleton clusters get 0, as in sklearn.metrics.silhouette_samples
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X_sq_norms is None:
+        X_sq_norms = np.einsum('ij,ij->i', X, X)
+    rows = np.asarray(rows)
+    result = np.empty((len(labelings), len(rows)))
+
+    step = block_rows(len(X), block_bytes)
+    for i in range(0, len(rows), step):
+        block = rows[i:i + step]
+        distances = np.sqrt(squared_distances(X[block], X, X_sq_norms))
+        # the diagonal of squared_distances is only zero up to rounding
+        distances[np.arange(len(block)), block] = 0
+        sums = labelings.cluster_sums(distances)
+
+        for l in range(len(labelings)):
+            codes = labelings.codes[l][block]
+            counts = labelings.counts[l]
+            cluster_sums = sums[:, labelings.offsets[l]:labelings.offsets[l + 1]]
+            own = np.arange(len(block)), codes
+            own_size = counts[codes]
+
+            a = cluster_sums[own] / np.maximum(own_size - 1, 1)
+            means = cluster_sums / counts
+            means[own] = np.inf
+            b = means.min(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                s = np.nan_to_num((b - a) / np.maximum(a, b))
+            s[own_size == 1] = 0
+            result[l, i:i + len(block)] = s
+    return result
+
+
+def silhouette_scores(X, labelings, block_bytes=1 << 28):
+    """Exact mean silhouette coefficient of every clustering, in bounded memory"""
+    if not isinstance(labelings, Labelings):
+        labelings = Labelings(labelings)
+    return list(silhouette_samples(X, labelings, np.arange(len(X)), block_bytes=block_bytes).mean(axis=1))
+
+
+def sampled_silhouette_scores(X, labelings, sample_size=10000, confidence=0.95, random_state=1234, block_bytes=1 << 28):
+    """Estimated mean silhouette coefficient of every clustering, as (estimate, ci_low, ci_high).
+
+    The coefficients of a random sample of rows are computed exactly, i.e. against all rows of X, so the sample
+    mean is an unbiased estimate of the score and the confidence interval narrows with the square root of sample_size
+    """
+    if not isinstance(labelings, Labelings):
+        labelings = Labelings(labelings)
+    rng = np.random.RandomState(random_state)
+    rows = np.sort(rng.choice(len(X), min(sample_size, len(X)), replace=False))
+    samples = silhouette_samples(X, labelings, rows, block_bytes=block_bytes)
+    return [confidence_interval(s, confidence) for s in samples]
+
+
+def confidence_interval(samples, confidence=0.95):
+    mean = samples.mean()
+    half_width = norm.ppf(0.5 + confidence / 2) * samples.std(ddof=1) / np.sqrt(len(samples)) if len(samples) > 1 else 0
+    return mean, mean - half_width, mean + half_width
+
+
+def calinski_harabaz_scores(X, labelings):
+    """Calinski-Harabasz score of every clustering, it only needs the cluster centroids so it is linear in N"""
+    return [calinski_harabaz_score(X, labels) for labels in labelings]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--random', type=int, nargs=2, metavar=('N', 'D'), default=(20000, 100))
+    parser.add_argument('--sample-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    # compare with sklearn on KMeans clusterings of clustered synthetic data
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    n, d = args.random
+    rng = np.random.RandomState(1234)
+    centers = rng.randn(20, d)
+    X = centers[rng.randint(20, size=n)] + rng.randn(n, d)
+    labelings = [KMeans(k, random_state=1234).fit_predict(X) for k in (2, 5, 10, 20)]
+
+    start = time.time()
+    exact = silhouette_scores(X, labelings)
+    print('chunked exact: {:.1f}s'.format(time.time() - start))
+    start = time.time()
+    sampled = sampled_silhouette_scores(X, labelings, args.sample_size)
+    print('sampled:       {:.1f}s'.format(time.time() - start))
+    start = time.time()
+    reference = [silhouette_score(X, labels) for labels in labelings]
+    print('sklearn:       {:.1f}s'.format(time.time() - start))
+    for r, e, s in zip(reference, exact, sampled):
+        print('sklearn {:.5f} chunked {:.5f} sampled {:.5f} [{:.5f}, {:.5f}]'.format(r, e, *s))
@@ -0,0 +1,132 @@
+import numpy as np
+import os
+import time
+import argparse
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import IncrementalPCA
+from sklearn.cluster import MiniBatchKMeans
+
+from tileutils.embedstore import EmbeddingStore, is_store
+
+
+def matrix_chunks(X, chunk_size=65536):
+    """Chunks of the rows of a matrix, e.g. a memory-mapped get_matrix column, only one chunk is read at a time"""
+    def chunks():
+        for i in range(0, len(X), chunk_size):
+            yield np.asarray(X[i:i + chunk_size], dtype=np.float64)
+    return chunks
+
+
+def embedding_chunks(df, embeddings_dir, chunk_size=65536):
+    """Chunks of the embeddings of the tiles in df.index, read from an embedding store or a directory of .npy files"""
+    def chunks():
+        if is_store(embeddings_dir):
+            store = EmbeddingStore(embeddings_dir)
+            rows = store.rows(df.index)
+            for i in range(0, len(rows), chunk_size):
+                yield np.asarray(store.vectors[rows[i:i + chunk_size]], dtype=np.float64)
+        else:
+            names = list(df.index)
+            for i in range(0, len(names), chunk_size):
+                yield np.vstack([np.load(os.path.join(embeddings_dir, name + '.npy')).reshape(1, -1)
+                                 for name in names[i:i + chunk_size]]).astype(np.float64)
+    return chunks
+
+
+def _at_least(chunks, min_rows):
+    """Merge a short last chunk into the one before, partial_fit needs at least min_rows rows"""
+    previous = None
+    for chunk in chunks():
+        if previous is not None:
+            if len(chunk) < min_rows:
+                chunk = np.vstack([previous, chunk])
+            else:
+                yield previous
+        previous = chunk
+    if previous is not None:
+        yield previous
+
+
+def streaming_pca(chunks, n_components=10, output_path=None):
+    """Out-of-core equivalent of analysis_util.get_pca: standardise, then project on the first n_components
+    principal components, reading the data three times in chunks (scaling statistics, IncrementalPCA fit,
+    transform). The projections go to an .npy file at output_path if given, memory-mapped, or to memory
+    """
+    start = time.time()
+    scaler = StandardScaler()
+    n = 0
+    for chunk in chunks():
+        scaler.partial_fit(chunk)
+        n += len(chunk)
+
+    pca = IncrementalPCA(n_components=n_components)
+    for chunk in _at_least(chunks, n_components):
+        pca.partial_fit(scaler.transform(chunk))
+    print(pca.explained_variance_)
+
+    if output_path is not None:
+        result = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(n, n_components))
+    else:
+        result = np.empty((n, n_components), dtype=np.float32)
+    i = 0
+    for chunk in chunks():
+        result[i:i + len(chunk)] = pca.transform(scaler.transform(chunk))
+        i += len(chunk)
+    print('streaming pca of {} rows in {:.1f}s'.format(n, time.time() - start))
+    return result
+
+
+def streaming_kmeans(chunks, n_clusters=10, n_epochs=5, batch_size=4096, random_state=None):
+    """Out-of-core equivalent of analysis_util.get_kmeans, MiniBatchKMeans fitted over n_epochs passes
+    through the chunks, then a last pass to label every row
+    """
+    start = time.time()
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state)
+    for epoch in range(n_epochs):
+        for chunk in _at_least(chunks, n_clusters):
+            for i in range(0, len(chunk), batch_size):
+                batch = chunk[i:i + batch_size]
+                if len(batch) >= n_clusters or hasattr(kmeans, 'cluster_centers_'):
+                    kmeans.partial_fit(batch)
+    labels = np.concatenate([kmeans.predict(chunk) for chunk in chunks()])
+    print('streaming kmeans of {} rows in {:.1f}s'.format(len(labels), time.time() - start))
+    return labels
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--random', type=int, nargs=2, metavar=('N', 'D'), default=(200000, 128))
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    # compare with the in-memory path of analysis_util.get_pca and get_kmeans
+    from sklearn import preprocessing
+    from sklearn.decomposition import PCA
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import adjusted_rand_score
+
+    n, d = args.random
+    rng = np.random.RandomState(1234)
+    X = (rng.randn(50, d) * 2)[rng.randint(50, size=n)] + rng.randn(n, d)
+
+    start = time.time()
+    scaled = preprocessing.scale(X)
+    pca = PCA(n_components=10).fit_transform(scaled)
+    labels = KMeans(n_clusters=args.k, random_state=1234).fit_predict(pca)
+    print('in memory: {:.1f}s'.format(time.time() - start))
+    labels_other_seed = KMeans(n_clusters=args.k, random_state=4321).fit_predict(pca)
+
+    start = time.time()
+    pca_stream = streaming_pca(matrix_chunks(X, args.chunk_size), 10)
+    labels_stream = streaming_kmeans(matrix_chunks(pca_stream, args.chunk_size), args.k, random_state=1234)
+    print('streaming: {:.1f}s'.format(time.time() - start))
+
+    # components are only defined up to their sign
+    signs = np.sign(np.sum(pca * pca_stream, axis=0))
+    print('max abs difference of the first 3 components: {:.4f} (of std {:.2f})'.format(
+        np.abs(pca[:, :3] - pca_stream[:, :3] * signs[:3]).max(), pca[:, 0].std()))
+    print('adjusted rand index, in memory vs streaming kmeans: {:.3f}, in memory with another seed: {:.3f}'.format(
+        adjusted_rand_score(labels, labels_stream), adjusted_rand_score(labels, labels_other_seed)))
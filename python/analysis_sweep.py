@@ -0,0 +1,153 @@
+import numpy as np
+import os
+import time
+from multiprocessing import Pool
+
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, cut_tree
+from sklearn.cluster import KMeans
+
+from analysis_scores import Labelings, silhouette_samples, calinski_harabaz_scores, confidence_interval
+
+# dataset name -> (N, D) matrix and dataset name -> Labelings of all k,
+# set in every worker process by the pool initializer
+_datasets = {}
+_labelings = {}
+
+
+def _init_worker(datasets, labelings=None):
+    global _datasets, _labelings
+    _datasets = datasets
+    _labelings = labelings or {}
+
+
+def _fit_kmeans(job):
+    dataset, k, random_state = job
+    X = _datasets[dataset]
+    model = KMeans(n_clusters=k, random_state=random_state).fit(X)
+    return dataset, k, model, model.score(X)
+
+
+def _ward_labels(job):
+    dataset, ks = job
+    return dataset, ward_labels(_datasets[dataset], ks)
+
+
+def _silhouette_samples(job):
+    dataset, rows = job
+    return dataset, rows, silhouette_samples(_datasets[dataset], _labelings[dataset], rows)
+
+
+def _run(fn, jobs, datasets, workers, labelings=None):
+    """Run fn over jobs, in a pool of worker processes sharing the dataset matrices if workers > 1"""
+    if workers <= 1:
+        _init_worker(datasets, labelings)
+        return list(map(fn, jobs))
+    pool = Pool(min(workers, len(jobs)), _init_worker, (datasets, labelings))
+    try:
+        return pool.map(fn, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ClusterSweep:
+    """Clusterings of one dataset for a range of k: labels and fitted model (KMeans only) per k,
+    and a scores table with one row per k
+    """
+
+    def __init__(self, ks):
+        self.ks = list(ks)
+        self.labels = {}
+        self.models = {}
+        self.scores = pd.DataFrame({'k': self.ks})
+
+    def set_scores(self, column, values):
+        self.scores[column] = [values[k] for k in self.ks]
+
+    def labels_df(self, k, index):
+        return pd.DataFrame({'cluster': self.labels[k]}, index=index)
+
+
+def ward_labels(X, ks):
+    """Ward clusterings for every k in ks from a single linkage tree, cut at each k.
+
+    Gives the same partitions as AgglomerativeClustering(k, linkage='ward') for each k, without
+    recomputing the tree every time
+    """
+    tree = linkage(X, 'ward')
+    cuts = cut_tree(tree, n_clusters=list(ks))
+    return {k: cuts[:, i] for i, k in enumerate(ks)}
+
+
+def score_sweeps(datasets, sweeps, workers=os.cpu_count(), sample_size=None, rows_per_job=4096):
+    """Silhouette and Calinski-Harabasz score of every clustering.
+
+    The silhouette of all k of a dataset is computed together, from the same distance blocks, with the rows
+    spread over the pool. With sample_size, the silhouette is estimated from that many rows and the
+    scores get a 95% confidence interval, silhouette_ci_low and silhouette_ci_high
+    """
+    start = time.time()
+    labelings = {dataset: Labelings([sweep.labels[k] for k in sweep.ks]) for dataset, sweep in sweeps.items()}
+    rows = {}
+    for dataset in sweeps:
+        n = len(datasets[dataset])
+        if sample_size is not None and sample_size < n:
+            rows[dataset] = np.sort(np.random.RandomState(1234).choice(n, sample_size, replace=False))
+        else:
+            rows[dataset] = np.arange(n)
+    jobs = [(dataset, rows[dataset][i:i + rows_per_job]) for dataset in sweeps
+            for i in range(0, len(rows[dataset]), rows_per_job)]
+
+    samples = {dataset: [] for dataset in sweeps}
+    for dataset, _, s in _run(_silhouette_samples, jobs, datasets, workers, labelings):
+        samples[dataset].append(s)
+
+    for dataset, sweep in sweeps.items():
+        # jobs come back in order, so the samples line up with rows[dataset]
+        s = np.hstack(samples[dataset])
+        sweep.set_scores('silhouette_score', dict(zip(sweep.ks, s.mean(axis=1))))
+        if len(s[0]) < len(datasets[dataset]):
+            intervals = [confidence_interval(x) for x in s]
+            sweep.set_scores('silhouette_ci_low', dict(zip(sweep.ks, [i[1] for i in intervals])))
+            sweep.set_scores('silhouette_ci_high', dict(zip(sweep.ks, [i[2] for i in intervals])))
+        ch = calinski_harabaz_scores(datasets[dataset], [sweep.labels[k] for k in sweep.ks])
+        sweep.set_scores('calinski_harabaz_score', dict(zip(sweep.ks, ch)))
+    print('scored {} clusterings in {:.1f}s'.format(sum(len(sweep.ks) for sweep in sweeps.values()), time.time() - start))
+    return sweeps
+
+
+def sweep_kmeans(datasets, ks=range(2, 21), workers=os.cpu_count(), random_state=None, score=True, sample_size=None):
+    """Fit KMeans for every k on every dataset (name -> matrix) in a process pool, returns name -> ClusterSweep"""
+    start = time.time()
+    sweeps = {dataset: ClusterSweep(ks) for dataset in datasets}
+    # largest k first, those take longest, so that the pool doesn't wait on a straggler at the end
+    jobs = [(dataset, k, random_state) for dataset in datasets for k in reversed(sweeps[dataset].ks)]
+    inertia = {dataset: {} for dataset in datasets}
+    for dataset, k, model, model_score in _run(_fit_kmeans, jobs, datasets, workers):
+        sweeps[dataset].models[k] = model
+        sweeps[dataset].labels[k] = model.labels_
+        inertia[dataset][k] = model_score
+    for dataset, sweep in sweeps.items():
+        sweep.set_scores('score', inertia[dataset])
+    print('kmeans sweep of {} fits in {:.1f}s'.format(len(jobs), time.time() - start))
+
+    if score:
+        score_sweeps(datasets, sweeps, workers, sample_size)
+    return sweeps
+
+
+def sweep_ward(datasets, ks=range(2, 21), workers=os.cpu_count(), score=True, sample_size=None):
+    """Ward clusterings for every k on every dataset, building one linkage tree per dataset in a process pool,
+    returns name -> ClusterSweep
+    """
+    start = time.time()
+    sweeps = {dataset: ClusterSweep(ks) for dataset in datasets}
+    jobs = [(dataset, sweeps[dataset].ks) for dataset in datasets]
+    for dataset, labels in _run(_ward_labels, jobs, datasets, workers):
+        sweeps[dataset].labels = labels
+    print('ward sweep of {} datasets in {:.1f}s'.format(len(datasets), time.time() - start))
+
+    if score:
+        score_sweeps(datasets, sweeps, workers, sample_size)
+    return sweeps
@@ -0,0 +1,155 @@
+import numpy as np
+import time
+import argparse
+
+from sklearn.manifold import TSNE
+
+from analysis_knn import exact_knn, squared_distances
+
+TSNE_METHODS = ('exact', 'barnes_hut', 'fft')
+
+
+def pca_init(pca):
+    """t-SNE initialisation from the first two principal components, e.g. a get_pca column,
+    scaled down to a standard deviation of 1e-4 like sklearn's init='pca'
+    """
+    Y = np.array(pca[:, :2], dtype=np.float32)
+    return Y / np.std(Y[:, 0]) * 1e-4
+
+
+def fit_tsne(X, perplexity=30, init='random', n_iter=3000, early_exaggeration=12.0, method='barnes_hut',
+             n_jobs=-1, random_state=None, verbose=3):
+    """2-D t-SNE layout of X.
+
+    init is 'random', 'pca' or an (N, 2) starting layout. method is 'barnes_hut' or 'exact' for sklearn's TSNE,
+    or 'fft' for the FFT-accelerated interpolation of openTSNE, much faster on large sets, if it is installed.
+    n_iter counts the 250 early exaggeration iterations, as in sklearn
+    """
+    if method not in TSNE_METHODS:
+        raise ValueError('invalid t-SNE method, expected one of {}'.format(TSNE_METHODS))
+    X = np.asarray(X, dtype=np.float32)
+
+    start = time.time()
+    if method == 'fft':
+        from openTSNE import TSNE as OpenTSNE
+        layout = np.asarray(OpenTSNE(perplexity=perplexity, initialization=init, early_exaggeration=early_exaggeration,
+                                     n_iter=max(n_iter - 250, 0), negative_gradient_method='fft', n_jobs=n_jobs,
+                                     random_state=random_state, verbose=verbose > 0).fit(X))
+    else:
+        layout = TSNE(perplexity=perplexity, init=init, n_iter=n_iter, early_exaggeration=early_exaggeration,
+                      method=method, n_jobs=n_jobs, random_state=random_state, verbose=verbose).fit_transform(X)
+    print('t-SNE of {} points with perplexity {} in {:.1f}s'.format(len(X), perplexity, time.time() - start))
+    return layout
+
+
+def warm_start_tsne(X, layout, perplexity, n_iter=750, **kwargs):
+    """Refit a layout computed with another perplexity, e.g. 30 to 5 or 100. The global structure is already
+    in place, so the early exaggeration phase is skipped and far fewer iterations are needed
+    """
+    return fit_tsne(X, perplexity, init=np.asarray(layout, dtype=np.float32), n_iter=n_iter, early_exaggeration=1.0, **kwargs)
+
+
+def conditional_probabilities(sq_distances, perplexity, tol=1e-5, max_iter=100):
+    """Gaussian affinities p_j|i over each row's neighbours, with the bandwidth of every row
+    set by binary search so that its perplexity matches, as in the t-SNE fit
+    """
+    n = len(sq_distances)
+    target = np.log(perplexity)
+    beta = np.ones(n)
+    lo, hi = np.zeros(n), np.full(n, np.inf)
+    d = sq_distances - sq_distances[:, :1]
+    for _ in range(max_iter):
+        p = np.exp(-d * beta[:, np.newaxis])
+        sum_p = p.sum(axis=1)
+        entropy = np.log(sum_p) + beta * (d * p).sum(axis=1) / sum_p
+        diff = entropy - target
+        if np.all(np.abs(diff) < tol):
+            break
+        # too high an entropy means too wide a kernel
+        wider = diff > 0
+        lo = np.where(wider, beta, lo)
+        hi = np.where(wider, hi, beta)
+        beta = np.where(np.isinf(hi), beta * 2, (lo + hi) / 2)
+    return p / sum_p[:, np.newaxis]
+
+
+def embed_new_points(X_ref, layout, X_new, perplexity=30, n_iter=100, learning_rate=1.0, grid_size=128):
+    """Place new points in an existing t-SNE layout of X_ref without refitting it.
+
+    Each new point starts at the affinity-weighted mean of its nearest reference points and is then moved by
+    gradient descent on its own t-SNE cost, with the reference layout fixed. Attraction comes from the
+    neighbours, repulsion from the reference points summarised as the centres of mass of a grid of cells
+    """
+    X_new = np.asarray(X_new, dtype=np.float32)
+    layout = np.asarray(layout, dtype=np.float64)
+    k = min(int(3 * perplexity), len(X_ref))
+
+    nn = exact_knn(np.asarray(X_ref, dtype=np.float32), k, X_new)
+    sq_distances = np.vstack([squared_distances(x[np.newaxis], np.asarray(X_ref)[row])[0] for x, row in zip(X_new, nn)])
+    P = conditional_probabilities(sq_distances, min(perplexity, k - 1))
+    neighbours = layout[nn]
+    Y = np.einsum('ij,ijk->ik', P, neighbours)
+
+    # reference layout summarised by grid cell
+    lo, hi = layout.min(axis=0), layout.max(axis=0)
+    cells = np.minimum(((layout - lo) / (hi - lo + 1e-12) * grid_size).astype(np.int64), grid_size - 1)
+    cell_ids = cells[:, 0] * grid_size + cells[:, 1]
+    counts = np.bincount(cell_ids, minlength=grid_size * grid_size)
+    occupied = np.flatnonzero(counts)
+    centres = np.stack([np.bincount(cell_ids, layout[:, i], minlength=grid_size * grid_size)[occupied]
+                        for i in range(2)], axis=1) / counts[occupied, np.newaxis]
+    counts = counts[occupied]
+
+    velocity = np.zeros_like(Y)
+    for _ in range(n_iter):
+        # attraction to the neighbours, as in the t-SNE gradient 4 * sum_j (p_ij - q_ij) w_ij (y_i - y_j)
+        diff = Y[:, np.newaxis, :] - neighbours
+        w = 1 / (1 + np.einsum('ijk,ijk->ij', diff, diff))
+        attraction = np.einsum('ij,ijk->ik', P * w, diff)
+        # repulsion from all reference points, through the cell centres
+        diff = Y[:, np.newaxis, :] - centres[np.newaxis]
+        w = 1 / (1 + np.einsum('ijk,ijk->ij', diff, diff))
+        z = (w * counts).sum(axis=1)
+        repulsion = np.einsum('ij,ijk->ik', w * w * counts, diff) / z[:, np.newaxis]
+        gradient = 4 * (attraction - repulsion)
+        velocity = 0.8 * velocity - learning_rate * gradient
+        Y += velocity
+    return Y.astype(np.float32)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--random', type=int, nargs=2, metavar=('N', 'D'), default=(10000, 50))
+    parser.add_argument('--method', choices=TSNE_METHODS, default='barnes_hut')
+    parser.add_argument('--held-out', type=int, default=500)
+    args = parser.parse_args()
+
+    # compare random and PCA initialisation, warm starting and embedding held-out points on clustered data
+    from sklearn.decomposition import PCA
+    n, d = args.random
+    rng = np.random.RandomState(1234)
+    labels = rng.randint(20, size=n)
+    X = (rng.randn(20, d) * 3)[labels] + rng.randn(n, d)
+    X_ref, X_new = X[args.held_out:], X[:args.held_out]
+
+    def neighbour_agreement(layout, Y_new):
+        """Fraction of new points whose nearest reference point in the layout is from the same cluster"""
+        nearest = exact_knn(layout.astype(np.float32), 1, Y_new.astype(np.float32))[:, 0]
+        return np.mean(labels[args.held_out:][nearest] == labels[:args.held_out])
+
+    start = time.time()
+    fit_tsne(X_ref, 30, 'random', method=args.method, verbose=0)
+    print('random init, 3000 iterations: {:.1f}s'.format(time.time() - start))
+    start = time.time()
+    layout = fit_tsne(X_ref, 30, pca_init(PCA(10).fit_transform(X_ref)), n_iter=1000, method=args.method, verbose=0)
+    print('PCA init, 1000 iterations:    {:.1f}s'.format(time.time() - start))
+    start = time.time()
+    warm_start_tsne(X_ref, layout, 5, method=args.method, verbose=0)
+    print('warm start perplexity 5:      {:.1f}s'.format(time.time() - start))
+
+    for n_iter in (0, 100):
+        start = time.time()
+        Y_new = embed_new_points(X_ref, layout, X_new, 30, n_iter=n_iter)
+        print('embedded {} new points with {} iterations in {:.2f}s, same cluster as nearest reference point {:.3f}'.format(
+            len(X_new), n_iter, time.time() - start, neighbour_agreement(layout, Y_new)))
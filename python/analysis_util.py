@@ -3,24 +3,35 @@ import os
 import pandas as pd
 import time
 import re
+import json
 import argparse
 
 from imageio import imread, imwrite
 from PIL import Image
-from sklearn.neighbors import NearestNeighbors
-from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans, AgglomerativeClustering
 from sklearn import preprocessing
-from sklearn.metrics import adjusted_rand_score
 
 from tileutils import usemodel, wrangle
+from tileutils.embedstore import EmbeddingStore, is_store
+from analysis_knn import exact_knn, approximate_knn, without_self
+from analysis_tsne import fit_tsne, warm_start_tsne, pca_init
+from analysis_stream import streaming_pca, streaming_kmeans, embedding_chunks, matrix_chunks
+from analysis_compare import compare_clusterings
+# a module import, analysis_cache imports this module back
+import analysis_cache
+
+COLUMNAR_META = 'columns.json'
+COLUMNAR_FRAME = 'frame.pkl'
+COLUMNAR_MATRICES = 'columnar_matrices'
 
 def read_df(input_file_path):
     if input_file_path.endswith('.csv'):
         return get_df_from_csv(input_file_path)
     elif input_file_path.endswith('.pkl'):
         return get_df_from_pickle(input_file_path)
+    elif input_file_path.endswith('.cols'):
+        return read_columnar(input_file_path)
     else:
         raise ValueError('invalid input file type')
 
@@ -28,10 +39,83 @@ def write_df(data, output_file_path):
     if output_file_path.endswith('.csv'):
         return data.to_csv(output_file_path)
     elif output_file_path.endswith('.pkl'):
-        return data.to_pickle(output_file_path)
+        return without_matrices(data).to_pickle(output_file_path)
+    elif output_file_path.endswith('.cols'):
+        return write_columnar(data, output_file_path)
     else:
         raise ValueError('invalid input file type')
 
+def is_vector_column(series):
+    # only numeric arrays can be memory-mapped, arrays of names like the knn nn column stay in the pickle
+    if series.dtype != object or len(series) == 0:
+        return False
+    first = series.iloc[0]
+    return isinstance(first, np.ndarray) and np.issubdtype(first.dtype, np.number)
+
+def write_columnar(data, output_dir):
+    """Write a dataframe as a directory: every vector column (one array per row, e.g. embeddings, t-SNE or PCA)
+    as an (N, D) <column>.npy, and the scalar columns and the index as a pickle
+    """
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        pass
+    vector_columns = [c for c in data.columns if is_vector_column(data[c])]
+    for c in vector_columns:
+        # replace rather than overwrite, the old file may be memory-mapped by data itself
+        path = os.path.join(output_dir, c + '.npy')
+        np.save(path + '.tmp.npy', get_matrix(data, c))
+        os.replace(path + '.tmp.npy', path)
+    without_matrices(data).drop(columns=vector_columns).to_pickle(os.path.join(output_dir, COLUMNAR_FRAME))
+    with open(os.path.join(output_dir, COLUMNAR_META), 'w') as f:
+        json.dump({'columns': list(data.columns), 'vector_columns': vector_columns}, f)
+
+def read_columnar(input_dir):
+    """Read a dataframe written by write_columnar, the vector columns are rows of memory-mapped matrices,
+    get_matrix gives back the whole (N, D) matrix without copying
+    """
+    with open(os.path.join(input_dir, COLUMNAR_META)) as f:
+        meta = json.load(f)
+    data = pd.read_pickle(os.path.join(input_dir, COLUMNAR_FRAME))
+    matrices = {}
+    for c in meta['vector_columns']:
+        # plain ndarray rows, slicing a memmap row by row is several times slower
+        matrices[c] = np.asarray(np.load(os.path.join(input_dir, c + '.npy'), mmap_mode='r'))
+        data[c] = list(matrices[c])
+    data = data[meta['columns']]
+    data.attrs[COLUMNAR_MATRICES] = {c: ColumnMatrix(matrix, data[c].values) for c, matrix in matrices.items()}
+    return data
+
+class ColumnMatrix:
+    """(N, D) matrix a vector column was read from, kept in the attrs of the frame read_columnar returns"""
+
+    def __init__(self, matrix, values):
+        self.matrix = matrix
+        # the object array of the column's rows, reassigning or subsetting the column replaces it
+        self.values = values
+
+    def __deepcopy__(self, memo):
+        # pandas deep copies attrs into every derived frame, share the matrix instead
+        return self
+
+    def holds(self, values):
+        return len(values) == len(self.values) and \
+            values.__array_interface__['data'][0] == self.values.__array_interface__['data'][0]
+
+def without_matrices(data):
+    """data without the read_columnar matrices in its attrs, which would otherwise be pickled along with it"""
+    data = data.copy(deep=False)
+    data.attrs.pop(COLUMNAR_MATRICES, None)
+    return data
+
+def get_matrix(data, col_name):
+    """(N, D) matrix of a vector column, the memory-mapped matrix itself if the column is still as read_columnar read it"""
+    values = data[col_name].values
+    column_matrix = data.attrs.get(COLUMNAR_MATRICES, {}).get(col_name)
+    if column_matrix is not None and column_matrix.holds(values):
+        return column_matrix.matrix
+    return np.vstack(values)
+
 def read_embedding(file_path):
     return np.squeeze(np.load(file_path))
 
@@ -54,32 +138,48 @@ def get_df_from_directory(directory):
     return data
 
 def get_embeddings(df, embeddings_dir):
+    if is_store(embeddings_dir):
+        # rows of the memory-mapped store matrix, no copies
+        store = EmbeddingStore(embeddings_dir)
+        return [store.vectors[i] for i in store.rows(df.index)]
     return df.index.map(lambda x: read_embedding(os.path.join(embeddings_dir, x+'.npy')))
 
-def get_knn(data, k, repr_col):
-    neigh = NearestNeighbors(k+1)
-
-    print('starting to fit knn')
-    start = time.time()
-    neigh.fit(np.stack(data[repr_col]))
-    print('elapsed {}s'.format(time.time() - start))
+def get_knn(data, k, repr_col, method='exact', chunk_size=4096, nlist=256, nprobe=8):
+    X = get_matrix(data, repr_col)
 
-    print('starting to assign knn values')
+    print('starting to find knn ({})'.format(method))
     start = time.time()
-    nn = data[repr_col].map(lambda arr: np.squeeze(neigh.kneighbors(arr.reshape(1,-1), return_distance=False))[1:])
+    # k+1 because one of the neighbours of every tile is the tile itself
+    if method == 'exact':
+        nn = exact_knn(X, k+1, chunk_size=chunk_size)
+    elif method == 'ivf':
+        nn = approximate_knn(X, k+1, nlist=nlist, nprobe=nprobe, chunk_size=chunk_size)
+    else:
+        raise ValueError('invalid knn method')
     print('elapsed {}s'.format(time.time() - start))
     print('finished knn')
 
-    return nn.map(lambda x: data.index[x].values)
+    return pd.Series([data.index.values[row] for row in without_self(nn, k)], index=data.index)
+
 
+def get_tsne(data, col_name, perplexity=30, init='random', n_iter=3000, method='barnes_hut', warm_start=False):
+    """t-SNE layout of a column, see analysis_tsne.fit_tsne.
 
-def get_tsne(data, col_name, perplexity=30):
-    tsne_embedding =  TSNE(verbose=3, perplexity=perplexity, n_iter=3000).fit_transform(np.vstack(data[col_name].values))
+    init is 'random', 'pca', or the name of a column to start from: a get_pca column, e.g. 'pca_roads',
+    or with warm_start a layout computed with another perplexity, e.g. 'tsne30_roads'
+    """
+    X = get_matrix(data, col_name)
+    if init in ('random', 'pca'):
+        tsne_embedding = fit_tsne(X, perplexity, init, n_iter, method=method)
+    elif warm_start:
+        tsne_embedding = warm_start_tsne(X, get_matrix(data, init), perplexity, min(n_iter, 750), method=method)
+    else:
+        tsne_embedding = fit_tsne(X, perplexity, pca_init(get_matrix(data, init)), n_iter, method=method)
     return list(tsne_embedding)
 
 
 def get_pca(data, col_name, n_components=10):
-    numbers = np.vstack(data[col_name])
+    numbers = get_matrix(data, col_name)
     numbers = preprocessing.scale(numbers)
     pca = PCA(n_components=n_components).fit(numbers)
     print(pca.explained_variance_)
@@ -88,18 +188,17 @@ def get_pca(data, col_name, n_components=10):
 
 
 def get_kmeans(data, col_name, n_clusters=10):
-    clusters = KMeans(n_clusters = n_clusters).fit_predict(np.vstack(data[col_name]))
+    clusters = KMeans(n_clusters = n_clusters).fit_predict(get_matrix(data, col_name))
     return list(clusters)
     
 def get_ward(data, col_name, n_cluster=10):
-    clusters = AgglomerativeClustering(n_cluster, linkage='ward').fit_predict(np.vstack(data[col_name]))
+    clusters = AgglomerativeClustering(n_cluster, linkage='ward').fit_predict(get_matrix(data, col_name))
     return list(clusters)
 
 
-def compare_clusters(data, cluster_columns):
-    comparison = pd.DataFrame([[adjusted_rand_score(data[c1], data[c2]) for c2 in cluster_columns] for c1 in cluster_columns], columns = cluster_columns)
-    comparison.index = cluster_columns
-    return comparison
+def compare_clusters(data, cluster_columns, score='ari'):
+    """Pairwise comparison of clustering columns, see analysis_compare.compare_clusterings for all scores at once"""
+    return compare_clusterings(data, cluster_columns)[score]
     
 
 def analyse_embeds(args, input_name, output_file_name):
@@ -113,35 +212,48 @@ def analyse_embeds(args, input_name, output_file_name):
     
     data = read_df(input_path)
 
-    if 'embeds' in args.modes:
-        if args.embed_dir_name is None:
+    stages = analysis_cache.CachedStages(args.cache_dir)
+
+    if 'embeds' in args.modes or 'pca-stream' in args.modes:
+        if args.embed_dir is None:
             raise ValueError('Embed dir name required')
-        embeddings_dir = os.path.join(data_root, 'embeds', args.embed_dir_name)
-        data['embed'] = get_embeddings(data, embeddings_dir)
+        embeddings_dir = os.path.join(data_root, 'embeds', args.embed_dir)
+
+    if 'embeds' in args.modes:
+        data['embed'] = stages.get_embeddings(data, embeddings_dir)
     
     # data = get_df_from_directory(embeddings_dir)
 
     if 'knn' in args.modes:
-        data['nn'] = get_knn(data, 5, 'embed')
+        data['nn'] = get_knn(data, 5, 'embed', args.knn_method)
 
     if 'tsne' in args.modes:
         if do_processing:
-            data['tsne'] =  get_tsne(data, 'embed', args.tsne_perplexity)
-        result = data.tsne.apply(pd.Series)
-        result.columns = ['tsne_x', 'tsne_y']
+            data['tsne'] = stages.get_tsne(data, 'embed', args.tsne_perplexity, args.tsne_init, method=args.tsne_method)
+        result = pd.DataFrame(get_matrix(data, 'tsne'), index=data.index, columns=['tsne_x', 'tsne_y'])
 
     if 'pca' in args.modes:
         n_components = args.pca_components
         if do_processing:
-            data['pca'] = get_pca(data, 'embed', n_components)
+            data['pca'] = stages.get_pca(data, 'embed', n_components)
         pca_col_list = ['pca'+str(i) for i in range(n_components)]
-        result = data.pca.apply(pd.Series)
-        result.columns = pca_col_list
+        result = pd.DataFrame(get_matrix(data, 'pca'), index=data.index, columns=pca_col_list)
 
-    if 'kmeans' in args.modes:
-        column_name = 'kmeans'
+    # out-of-core variants of pca and kmeans, reading the embeddings and principal components in chunks,
+    # for tile sets too large to hold in memory
+    if 'pca-stream' in args.modes:
+        n_components = args.pca_components
         if do_processing:
-            data[column_name] = get_kmeans(data, 'pca', args.kmeans_clusters)
+            data['pca'] = list(streaming_pca(embedding_chunks(data, embeddings_dir, args.chunk_size), n_components))
+        pca_col_list = ['pca'+str(i) for i in range(n_components)]
+        result = pd.DataFrame(get_matrix(data, 'pca'), index=data.index, columns=pca_col_list)
+
+    if 'kmeans' in args.modes or 'kmeans-stream' in args.modes:
+        column_name = 'kmeans'
+        if do_processing and 'kmeans' in args.modes:
+            data[column_name] = stages.get_kmeans(data, 'pca', args.kmeans_clusters)
+        elif do_processing:
+            data[column_name] = streaming_kmeans(matrix_chunks(get_matrix(data, 'pca'), args.chunk_size), args.kmeans_clusters)
         result = data[[column_name]]
 
     if args.result_only:
@@ -161,8 +273,13 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--prefix')
     parser.add_argument('--embed-dir')
     parser.add_argument('--tsne-perplexity', type=int, default=30)
+    parser.add_argument('--tsne-init', choices=['random', 'pca'], default='random')
+    parser.add_argument('--tsne-method', choices=['exact', 'barnes_hut', 'fft'], default='barnes_hut')
     parser.add_argument('--pca-components', type=int, default=10)
     parser.add_argument('--kmeans-clusters', type=int, default=5)
+    parser.add_argument('--knn-method', choices=['exact', 'ivf'], default='exact')
+    parser.add_argument('--cache-dir', help='cache the embeds, tsne, pca and kmeans results here')
+    parser.add_argument('--chunk-size', type=int, default=65536, help='rows per chunk for pca-stream and kmeans-stream')
 
     args = parser.parse_args()
 
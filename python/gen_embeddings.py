@@ -4,17 +4,31 @@ import argparse
 
 from imageio import imread, imwrite
 
-from tileutils import usemodel
+from tileutils import usemodel, pipeline, stats
 
 
-def generate_embeddings(model_name, input_name, colors, reverse=True):
-    data_root = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data')
-    
-    model_root = os.path.join(data_root, 'models', 'vaegan')
-    
+def get_data_root():
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data')
+
+
+def get_model_dirs(model_name):
+    model_root = os.path.join(get_data_root(), 'models', 'vaegan')
 
     dec_dir = os.path.join(model_root, model_name, 'saved_model_embed_in', '1')
     enc_dir = os.path.join(model_root, model_name, 'saved_model_image_in', '1')
+    return enc_dir, dec_dir
+
+
+def generate_embeddings(model_name, input_name, colors, reverse=True, batch_size=64, pipelined=False, readers=4, writers=4, queue_size=8,
+                        embed_store=False, incremental=False, reconstructions='all', reconstruction_n=1, window_stride=None, regions=(),
+                        min_coverage=None, max_coverage=None, coverage_channels=None):
+    if window_stride is not None:
+        generate_window_embeddings(model_name, input_name, regions, window_stride, batch_size)
+        return
+
+    data_root = get_data_root()
+
+    enc_dir, dec_dir = get_model_dirs(model_name)
 
     encoder = usemodel.Encoder(enc_dir)
     decoder = usemodel.Decoder(dec_dir)
@@ -29,13 +43,58 @@ def generate_embeddings(model_name, input_name, colors, reverse=True):
     except OSError:
         pass
     
+    if reconstructions != 'none':
+        try:
+            os.makedirs(reconstruction_output_dir)
+        except OSError:
+            pass
+
+    tile_filter = None
+    if min_coverage is not None or max_coverage is not None:
+        # skip blank tiles, the coverage index of the tile set is (re)built when missing or out of date
+        stats_dir = os.path.join(data_root, 'stats')
+        try:
+            os.makedirs(stats_dir)
+        except OSError:
+            pass
+        tile_filter = stats.coverage_filter(os.path.join(stats_dir, input_name + '.npz'), input_dir,
+                                            min_coverage, max_coverage, coverage_channels)
+
+    options = dict(reverse=reverse, batch_size=batch_size, embed_store=embed_store, incremental=incremental,
+                   reconstructions=reconstructions, reconstruction_n=reconstruction_n, tile_filter=tile_filter)
+
+    if pipelined:
+        pipeline.use_model_pipelined(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, colors,
+                                     readers=readers, writers=writers, queue_size=queue_size, **options)
+    else:
+        usemodel.use_model(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, colors, **options)
+
+
+def generate_window_embeddings(model_name, input_name, regions, stride=0.5, batch_size=64):
+    """Sliding-window embedding rasters of each region, written to embeds/<model_name>-windows/<region>.npy"""
+    data_root = get_data_root()
+    enc_dir, _ = get_model_dirs(model_name)
+    encoder = usemodel.Encoder(enc_dir)
+
+    input_dir = os.path.join(data_root, 'tiles', input_name)
+    embed_output_dir = os.path.join(data_root, 'embeds', model_name + '-windows')
     try:
-        os.makedirs(reconstruction_output_dir)
+        os.makedirs(embed_output_dir)
     except OSError:
         pass
 
-    usemodel.use_model(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, colors, reverse )
+    usemodel.use_model_windows(encoder, input_dir, embed_output_dir, regions, stride, batch_size)
+
 
+def read_regions(path):
+    """Regions to scan, one "name zoom col_min row_min col_max row_max" per line"""
+    regions = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 6:
+                regions.append((fields[0],) + tuple(int(x) for x in fields[1:]))
+    return regions
 
 
 if __name__ == '__main__':
@@ -45,8 +104,34 @@ if __name__ == '__main__':
 
     parser.add_argument('-c', '--colors', nargs='*', default=["0,0,1", "0,1,0", "1,1,1", "1,0,0"])
     parser.add_argument('-r', '--reverse', action='store_true', default=False)
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    parser.add_argument('-p', '--pipeline', action='store_true', default=False)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('-s', '--store', action='store_true', default=False)
+    parser.add_argument('-i', '--incremental', action='store_true', default=False)
+    parser.add_argument('--recons', choices=usemodel.RECONSTRUCTION_MODES, default='all')
+    parser.add_argument('--recons-n', type=int, default=1)
+    parser.add_argument('-w', '--window-stride', type=float, help='slide a window over the regions instead, stride in tiles')
+    parser.add_argument('--region', nargs=6, action='append', default=[], metavar=('NAME', 'ZOOM', 'COL_MIN', 'ROW_MIN', 'COL_MAX', 'ROW_MAX'))
+    parser.add_argument('--regions-file')
+    parser.add_argument('--min-coverage', type=float, help='only encode tiles with at least this coverage, see tileutils.stats')
+    parser.add_argument('--max-coverage', type=float, help='no upper bound by default, summed coverage can exceed 1')
+    parser.add_argument('--coverage-channels', type=int, nargs='*', help='channels to sum the coverage of, all by default')
     args = parser.parse_args()
 
+    regions = [(r[0],) + tuple(int(x) for x in r[1:]) for r in args.region]
+    if args.regions_file:
+        regions.extend(read_regions(args.regions_file))
+    if args.recons_n < 1:
+        parser.error('--recons-n must be at least 1')
+    if args.window_stride is not None and not regions:
+        parser.error('--window-stride needs at least one --region or a --regions-file')
+
     color_tuples = [tuple(int(x) for x in c.split(',')) for c in args.colors]
 
-    generate_embeddings(args.model_name, args.input_name, color_tuples, args.reverse)
\ No newline at end of file
+    generate_embeddings(args.model_name, args.input_name, color_tuples, args.reverse, args.batch_size,
+                        args.pipeline, args.readers, args.writers, args.queue_size, args.store,
+                        args.incremental, args.recons, args.recons_n, args.window_stride, regions,
+                        args.min_coverage, args.max_coverage, args.coverage_channels)
\ No newline at end of file
@@ -5,6 +5,7 @@ from imageio import imread, imwrite
 from PIL import Image
 
 from tileutils import usemodel, wrangle
+from tileutils.latent import Traversal, AnchorEncodings, strip, save_sprite_sheet
 
 def lerp(a, b, t):
     return a * (1 - t) + b * t
@@ -14,7 +15,7 @@ def interp(a, b, k):
     return [lerp(a, b, i*1.0/k) for i in range(k+1)]
     
 def shift(a, d, s, k):
-    mvt = np.zeros(100)
+    mvt = np.zeros(a.shape[-1])
     mvt[d]=s
     return a + mvt * k
 
@@ -28,11 +29,17 @@ def get_model(model_name):
     
     return encoder, decoder
     
+# anchor encodings of each (encoder, tiles) pair, every tile is only encoded once
+_anchors = {}
+
+def get_anchors(encoder, input_name):
+    key = (id(encoder), input_name)
+    if key not in _anchors:
+        _anchors[key] = AnchorEncodings(encoder, os.path.join('..','data','tiles', input_name))
+    return _anchors[key]
+
 def get_encoding(encoder, input_name, name):
-    input_dir = os.path.join('..','data','tiles', input_name)
-    img = usemodel.read_img_bytes(os.path.join(input_dir, name+'.png'))
-    enc = encoder.encode(img)
-    return enc
+    return get_anchors(encoder, input_name)[name].reshape(1, -1)
     
     
 colors_lookup = {
@@ -41,12 +48,15 @@ colors_lookup = {
     'rbw': ((1,0,0), (1,1,1), (0,0,1))
 }
     
-def decode_list(decoder, encodings, colors, reverse=False):
-    images = [wrangle.cat_to_display(decoder.decode(enc), colors, reverse) for enc in encodings]
+def decode_list(decoder, encodings, colors, reverse=False, batch_size=256):
+    encodings = np.vstack([np.reshape(enc, (1, -1)) for enc in encodings])
+    images = []
+    for i in range(0, len(encodings), batch_size):
+        images.extend(wrangle.cat_to_display_batch(decoder.decode_batch(encodings[i:i + batch_size]), colors, reverse))
     return images
     
-def show(images, _):
-    res = np.hstack(images)
+def show(images, _=None):
+    res = strip(images)
     im = Image.fromarray(res)
     im.show()
     
@@ -62,19 +72,20 @@ def save(images, output_folder):
         imwrite(path, img)
     
     
+def get_traversal(encoder, decoder, input_name, entity_type):
+    return Traversal(get_anchors(encoder, input_name), decoder, colors_lookup[entity_type])
+    
+    
 def interp_files(encoder, decoder, input_name, output_dir, name1, name2, entity_type, n=10):
-    enc1 = get_encoding(encoder, input_name, name1)
-    enc2 = get_encoding(encoder, input_name, name2)
-    interpolations = interp(enc1, enc2, n)
-    images = decode_list(decoder, interpolations, colors_lookup[entity_type])
-    return images
+    traversal = get_traversal(encoder, decoder, input_name, entity_type)
+    traversal.lerp(name1, name2, n)
+    return traversal.decode()[0]
     
     
 def move_vector(encoder, decoder, input_name, output_dir, name1, dimension, step, entity_type):
-    enc1 = get_encoding(encoder, input_name, name1)
-    movements = [shift(enc1, dimension, step, i) for i in range(11)]
-    images = decode_list(decoder, movements, colors_lookup[entity_type])
-    return images
+    traversal = get_traversal(encoder, decoder, input_name, entity_type)
+    traversal.sweep(name1, dimension, step)
+    return traversal.decode()[0]
     
     
 def randomize_vector(encoder, decoder, input_name, output_dir, name1, entity_type, mult=1):
@@ -82,6 +93,24 @@ def randomize_vector(encoder, decoder, input_name, output_dir, name1, entity_typ
     movements = [enc1 + mult* np.random.randn() for i in range(11)]
     images = decode_list(decoder, movements, colors_lookup[entity_type])
     return images
+    
+    
+def latent_walks(encoder, decoder, input_name, output_path, names, entity_type, n=10, dimensions=(), step=10, walks=0, scale=1.0):
+    """Interpolations between every consecutive pair of names, sweeps of each name along dimensions and
+    random walks from each name, all decoded together and saved as a sprite sheet, one row per path
+    """
+    traversal = get_traversal(encoder, decoder, input_name, entity_type)
+    traversal.anchors.encode(names)
+    for name1, name2 in zip(names[:-1], names[1:]):
+        traversal.lerp(name1, name2, n)
+    for name in names:
+        for dimension in dimensions:
+            traversal.sweep(name, dimension, step, n + 1)
+        for i in range(walks):
+            traversal.walk(name, n + 1, scale, random_state=i)
+    paths = traversal.decode()
+    save_sprite_sheet(paths, output_path)
+    return paths
 
 
 rbw_enc, rbw_dec = get_model('france_15_rbw_128_full')
@@ -101,4 +130,9 @@ save(interp_files(r_enc, r_dec, 'france-ghs-15-roads-cat', '', '15_16566_11265',
 
 save(interp_files(rbw_enc, rbw_dec, 'france-ghs-15-rbw-cat', '', '15_16620_11260', '15_16591_11274', 'rbw'), 'interp_rbw__15_16620_11260__15_16591_11274')
 
-#15_17031_11962
\ No newline at end of file
+#15_17031_11962
+
+# many latent walks at once, one sprite sheet row per path
+
+latent_walks(r_enc, r_dec, 'france-ghs-15-roads-cat', '../data/analysis/latent/walks_roads.png',
+             ['15_16620_11260', '15_16591_11274', '15_16566_11265', '15_16583_11295'], 'roads', dimensions=range(10), walks=5)
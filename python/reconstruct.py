@@ -0,0 +1,44 @@
+import os
+import argparse
+
+from tileutils import usemodel
+from gen_embeddings import get_data_root, get_model_dirs
+
+
+def reconstruct_tiles(model_name, names, colors, reverse=False, batch_size=64, embed_dir_name=None):
+    data_root = get_data_root()
+
+    enc_dir, dec_dir = get_model_dirs(model_name)
+    decoder = usemodel.Decoder(dec_dir)
+
+    embeddings_dir = os.path.join(data_root, 'embeds', embed_dir_name or model_name)
+    reconstruction_output_dir = os.path.join(data_root, 'recons', model_name)
+
+    try:
+        os.makedirs(reconstruction_output_dir)
+    except OSError:
+        pass
+
+    usemodel.reconstruct(decoder, embeddings_dir, names, reconstruction_output_dir, colors, reverse, batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_name')
+    parser.add_argument('names', nargs='*')
+
+    parser.add_argument('-f', '--names-file')
+    parser.add_argument('-e', '--embed-dir')
+    parser.add_argument('-c', '--colors', nargs='*', default=["0,0,1", "0,1,0", "1,1,1", "1,0,0"])
+    parser.add_argument('-r', '--reverse', action='store_true', default=False)
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    names = list(args.names)
+    if args.names_file:
+        with open(args.names_file) as f:
+            names.extend(line.strip() for line in f if line.strip())
+
+    color_tuples = [tuple(int(x) for x in c.split(',')) for c in args.colors]
+
+    reconstruct_tiles(args.model_name, names, color_tuples, args.reverse, args.batch_size, args.embed_dir)
@@ -0,0 +1,58 @@
+import time
+import argparse
+
+import numpy as np
+
+from .wrangle import standard_cat_colors, cat_to_display, cat_to_display_pil, cat_to_display_batch
+
+
+def random_cat_tiles(n, size=128, channels=4, seed=1234):
+    """Synthetic categorical tiles: mostly empty or full coverage per channel, with anti-aliased edges"""
+    rng = np.random.RandomState(seed)
+    tiles = rng.choice([0, 255], size=(n, size, size, channels), p=[0.7, 0.3]).astype(np.uint8)
+    edges = rng.rand(n, size, size, channels) < 0.1
+    tiles[edges] = rng.randint(1, 255, size=edges.sum())
+    return tiles
+
+
+def bench_compositing(n=256, size=128, channels=4, reverse=False):
+    tiles = random_cat_tiles(n, size, channels)
+    colors = standard_cat_colors[:channels]
+
+    start = time.time()
+    reference = [cat_to_display_pil(tile, colors, reverse) for tile in tiles]
+    pil_elapsed = time.time() - start
+
+    start = time.time()
+    single = [cat_to_display(tile, colors, reverse) for tile in tiles]
+    single_elapsed = time.time() - start
+
+    start = time.time()
+    batch = cat_to_display_batch(tiles, colors, reverse)
+    batch_elapsed = time.time() - start
+
+    identical = all(np.array_equal(r, s) and np.array_equal(r, b) for r, s, b in zip(reference, single, batch))
+
+    print('{} tiles of {}x{}x{}'.format(n, size, size, channels))
+    print('PIL per tile:   {:.3f}s ({:.1f} tiles/s)'.format(pil_elapsed, n / pil_elapsed))
+    print('NumPy per tile: {:.3f}s ({:.1f} tiles/s)'.format(single_elapsed, n / single_elapsed))
+    print('NumPy batch:    {:.3f}s ({:.1f} tiles/s)'.format(batch_elapsed, n / batch_elapsed))
+    print('identical output:', identical)
+    return identical
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--mode', choices=['compositing'], default='compositing')
+    parser.add_argument('-n', '--tiles', type=int, default=256)
+    parser.add_argument('-s', '--size', type=int, default=128)
+    parser.add_argument('-x', '--channels', type=int, default=4)
+    parser.add_argument('-r', '--reverse', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.mode == 'compositing':
+        bench_compositing(args.tiles, args.size, args.channels, args.reverse)
+
+
+if __name__ == '__main__':
+    main()
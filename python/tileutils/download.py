@@ -0,0 +1,265 @@
+import os
+import time
+import argparse
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .shards import ShardWriter, ShardReader, is_shard_dir, png_to_array, array_to_png
+from .wrangle import imgs_to_ndarr
+from .embedstore import tile_name
+
+STYLE_PATH = '/styles/gan-plan-{style}/{zoom}/{col}/{row}.png'
+STYLES = ('roads', 'buildings', 'water', 'greenery')
+
+
+def read_tile_list(path, start=0):
+    """Read a [col, row, zoom] per line tile list, as produced by supermercado and used by download-tiles.sh"""
+    tiles = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().strip('[]').replace(',', ' ').split()
+            if len(fields) == 3:
+                col, row, zoom = (int(x) for x in fields)
+                tiles.append((col, row, zoom))
+    return tiles[start:]
+
+
+def tile_filename(tile):
+    col, row, zoom = tile
+    return '{}_{}_{}.png'.format(zoom, col, row)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, path):
+        super().__init__('HTTP {} for {}'.format(status, path))
+        self.status = status
+
+
+class TileClient:
+    """Fetches tiles over one keep-alive connection per thread, retrying failed requests with exponential backoff"""
+
+    def __init__(self, server='localhost:8080', retries=5, backoff=0.5, timeout=30):
+        self.server = server
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(self.server, timeout=self.timeout)
+        return self.local.connection
+
+    def _reset(self):
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+        self.local.connection = None
+
+    def get(self, path):
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._connection()
+                connection.request('GET', path)
+                response = connection.getresponse()
+                # always read the body so the connection can be reused
+                data = response.read()
+                if response.status == 200:
+                    return data
+                error = HTTPError(response.status, path)
+                if response.status < 500 and response.status != 429:
+                    # retrying won't help for client errors like 404
+                    raise error
+            except (OSError, http.client.HTTPException) as e:
+                self._reset()
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    def get_tile(self, style, tile):
+        col, row, zoom = tile
+        return self.get(STYLE_PATH.format(style=style, zoom=zoom, col=col, row=row))
+
+
+class DirectoryOutput:
+    """Writes tiles to <root>/<zoom>/<style>/<zoom>_<col>_<row>.png, the layout split-cat reads from.
+
+    Tiles without a style, i.e. fused categorical tiles, go straight to <root>/<zoom>_<col>_<row>.png
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, style, tile):
+        if style is None:
+            return os.path.join(self.root, tile_filename(tile))
+        return os.path.join(self.root, str(tile[2]), style, tile_filename(tile))
+
+    def exists(self, style, tile):
+        return os.path.exists(self.path(style, tile))
+
+    def write(self, style, tile, data):
+        path = self.path(style, tile)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        if not isinstance(data, bytes):
+            data = array_to_png(data)
+        # write then rename, so an interrupted run never leaves a truncated tile behind to be resumed from
+        tmp_path = path + '.part'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        pass
+
+
+class ShardOutput:
+    """Writes tiles to one shard set per zoom and style, <root>/<zoom>/<style>/, or to <root> for fused categorical tiles"""
+
+    def __init__(self, root, compression='png'):
+        self.root = root
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.writers = {}
+        self.existing = {}
+
+    def _dir(self, style, tile):
+        if style is None:
+            return self.root
+        return os.path.join(self.root, str(tile[2]), style)
+
+    def exists(self, style, tile):
+        shard_dir = self._dir(style, tile)
+        if shard_dir not in self.existing:
+            self.existing[shard_dir] = set(ShardReader(shard_dir).names) if is_shard_dir(shard_dir) else set()
+        return tile_name(tile_filename(tile)) in self.existing[shard_dir]
+
+    def write(self, style, tile, data):
+        shard_dir = self._dir(style, tile)
+        with self.lock:
+            if shard_dir not in self.writers:
+                self.writers[shard_dir] = ShardWriter(shard_dir, self.compression)
+            self.writers[shard_dir].add(tile_filename(tile), data)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def run_jobs(fn, jobs, concurrency, max_pending=None):
+    """Run fn over jobs on a thread pool, keeping at most max_pending jobs in flight, yields (job, result, error)"""
+    max_pending = max_pending or concurrency * 4
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = {}
+        while True:
+            for job in jobs:
+                pending[executor.submit(fn, job)] = job
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                error = future.exception()
+                yield job, None if error else future.result(), error
+
+
+def download_tiles(tiles, styles, output, client, concurrency=16):
+    """Download every style of every tile which is not in output yet, returns the list of failed (style, tile) jobs"""
+    jobs = [(style, tile) for tile in tiles for style in styles if not output.exists(style, tile)]
+    n = len(jobs)
+    print('{} of {} tile images to download'.format(n, len(tiles) * len(styles)))
+
+    def fetch(job):
+        style, tile = job
+        output.write(style, tile, client.get_tile(style, tile))
+
+    start = time.time()
+    failed = []
+    try:
+        print() # print an empty new line
+        for i, (job, _, error) in enumerate(run_jobs(fetch, jobs, concurrency)):
+            if error is not None:
+                failed.append(job)
+                print('\nFailed {} {}: {}'.format(job[0], tile_filename(job[1]), error))
+            if i % 100 == 0:
+                print('\rDownloading tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+    finally:
+        output.close()
+    print()
+
+    elapsed = time.time() - start
+    print('{} tile images downloaded, {} failed, in {:.1f}s ({:.1f} tiles/s with {} connections)'.format(
+        n - len(failed), len(failed), elapsed, (n - len(failed)) / elapsed if elapsed > 0 else 0, concurrency))
+    return failed
+
+
+def download_cat_tiles(tiles, channel_defs, output, client, concurrency=16):
+    """Fused download and split-cat: fetch the style layers of each tile, stack the selected channels in memory
+    and write only the final categorical tile. Returns the list of failed tiles
+    """
+    jobs = [tile for tile in tiles if not output.exists(None, tile)]
+    n = len(jobs)
+    print('{} of {} categorical tiles to download'.format(n, len(tiles)))
+
+    def fetch(tile):
+        img_defs = [(png_to_array(client.get_tile(style, tile)), channel) for style, channel in channel_defs]
+        output.write(None, tile, imgs_to_ndarr(*img_defs))
+
+    start = time.time()
+    failed = []
+    try:
+        print() # print an empty new line
+        for i, (tile, _, error) in enumerate(run_jobs(fetch, jobs, concurrency)):
+            if error is not None:
+                failed.append(tile)
+                print('\nFailed {}: {}'.format(tile_filename(tile), error))
+            if i % 100 == 0:
+                print('\rDownloading tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+    finally:
+        output.close()
+    print()
+
+    elapsed = time.time() - start
+    print('{} categorical tiles written, {} failed, in {:.1f}s ({:.1f} tiles/s with {} connections)'.format(
+        n - len(failed), len(failed), elapsed, (n - len(failed)) / elapsed if elapsed > 0 else 0, concurrency))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tile_list')
+    parser.add_argument('output_directory')
+    parser.add_argument('-t', '--types', nargs='*', default=list(STYLES))
+    parser.add_argument('-s', '--server', default='localhost:8080')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('-n', '--concurrency', type=int, default=16)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--backoff', type=float, default=0.5)
+    parser.add_argument('--shards', action='store_true', default=False)
+    parser.add_argument('--cat', action='store_true', default=False)
+    parser.add_argument('-x', '--channels', type=int, nargs='*')
+    args = parser.parse_args()
+
+    if args.cat and (args.channels is None or len(args.types) != len(args.channels)):
+        raise ValueError('Need the same number of channel definitions as types')
+
+    tiles = read_tile_list(args.tile_list, args.start)
+    output = ShardOutput(args.output_directory) if args.shards else DirectoryOutput(args.output_directory)
+    client = TileClient(args.server, args.retries, args.backoff)
+
+    if args.cat:
+        download_cat_tiles(tiles, list(zip(args.types, args.channels)), output, client, args.concurrency)
+    else:
+        download_tiles(tiles, args.types, output, client, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import os
+import json
+import argparse
+import threading
+
+import numpy as np
+
+META_FILE = 'embeddings.json'
+VECTORS_FILE = 'embeddings.f32'
+NAMES_FILE = 'names.txt'
+
+
+def is_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, META_FILE))
+
+
+def tile_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _read_meta(store_dir):
+    with open(os.path.join(store_dir, META_FILE)) as f:
+        return json.load(f)
+
+
+def _read_names(store_dir):
+    names_path = os.path.join(store_dir, NAMES_FILE)
+    if not os.path.exists(names_path):
+        return []
+    with open(names_path) as f:
+        return f.read().splitlines()
+
+
+class EmbeddingWriter:
+    """Appends embeddings to a store: a contiguous float32 matrix file plus a tile name per row.
+
+    Rows are buffered and written in chunks, appending to an existing store if there is one.
+    on_flush, if given, is called with the tile names of every chunk once it is on disk.
+    Safe to share between threads
+    """
+
+    def __init__(self, store_dir, dim=None, chunk_size=1024, on_flush=None):
+        self.store_dir = store_dir
+        self.chunk_size = chunk_size
+        self.on_flush = on_flush
+        self.lock = threading.Lock()
+        self.names = []
+        self.vectors = []
+
+        try:
+            os.makedirs(store_dir)
+        except OSError:
+            pass
+
+        if is_store(store_dir):
+            self.dim = _read_meta(store_dir)['dim']
+            if dim is not None and dim != self.dim:
+                raise ValueError('Store has dimension {}, cannot append vectors of dimension {}'.format(self.dim, dim))
+            self._truncate_partial_rows()
+        else:
+            self.dim = dim
+            if dim is not None:
+                self._write_meta()
+
+    def _write_meta(self):
+        with open(os.path.join(self.store_dir, META_FILE), 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': 'float32'}, f)
+
+    def _truncate_partial_rows(self):
+        # an interrupted write can leave the two files out of step, keep only the complete rows
+        names = _read_names(self.store_dir)
+        vectors_path = os.path.join(self.store_dir, VECTORS_FILE)
+        row_bytes = self.dim * 4
+        size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+        n = min(len(names), size // row_bytes)
+        if n != len(names):
+            with open(os.path.join(self.store_dir, NAMES_FILE), 'w') as f:
+                f.writelines(name + '\n' for name in names[:n])
+        if size != n * row_bytes:
+            with open(vectors_path, 'ab') as f:
+                f.truncate(n * row_bytes)
+
+    def append(self, names, embs):
+        embs = np.asarray(embs, dtype=np.float32).reshape((len(names), -1))
+        with self.lock:
+            if self.dim is None:
+                self.dim = embs.shape[1]
+                self._write_meta()
+            elif embs.shape[1] != self.dim:
+                raise ValueError('Expected vectors of dimension {}, got {}'.format(self.dim, embs.shape[1]))
+            self.names.extend(tile_name(name) for name in names)
+            self.vectors.append(embs)
+            if len(self.names) >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.names:
+            return
+        # vectors first, so that a crash in between never leaves a name without its row
+        with open(os.path.join(self.store_dir, VECTORS_FILE), 'ab') as f:
+            np.concatenate(self.vectors).tofile(f)
+        with open(os.path.join(self.store_dir, NAMES_FILE), 'a') as f:
+            f.writelines(name + '\n' for name in self.names)
+        if self.on_flush is not None:
+            self.on_flush(self.names)
+        self.names = []
+        self.vectors = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EmbeddingStore:
+    """Read-only, memory-mapped view of an embedding store"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        meta = _read_meta(store_dir)
+        self.dim = meta['dim']
+        names = _read_names(store_dir)
+
+        vectors_path = os.path.join(store_dir, VECTORS_FILE)
+        n_rows = os.path.getsize(vectors_path) // (self.dim * 4) if os.path.exists(vectors_path) else 0
+        self.names = names[:n_rows]
+        if self.names:
+            self.vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(len(self.names), self.dim))
+        else:
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        # later rows win, so re-appended tiles replace their older vectors
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def rows(self, names):
+        return np.array([self.index[name] for name in names], dtype=np.int64)
+
+    def get(self, name):
+        return self.vectors[self.index[name]]
+
+    def latest_rows(self):
+        """Row of every tile name, the newest one of re-appended tiles, in storage order"""
+        return np.array(sorted(self.index.values()), dtype=np.int64)
+
+    def matrix(self, names=None):
+        """(N, D) matrix for the given names, a zero-copy view when they form a contiguous run of rows.
+        All names by default, each only once with its newest vector
+        """
+        if names is None:
+            if len(self.index) == len(self.names):
+                return self.vectors
+            return self.vectors[self.latest_rows()]
+        rows = self.rows(names)
+        if len(rows) and np.all(np.diff(rows) == 1):
+            return self.vectors[rows[0]:rows[-1] + 1]
+        return self.vectors[rows]
+
+
+def compact(store_dir):
+    """Rewrite a store keeping only the newest row of every tile name, incremental runs append a row
+    for every re-encoded tile. Returns the number of rows dropped
+    """
+    store = EmbeddingStore(store_dir)
+    dropped = len(store.names) - len(store.index)
+    if not dropped:
+        return 0
+    rows = store.latest_rows()
+    vectors_path = os.path.join(store_dir, VECTORS_FILE)
+    names_path = os.path.join(store_dir, NAMES_FILE)
+    np.asarray(store.vectors[rows]).tofile(vectors_path + '.tmp')
+    with open(names_path + '.tmp', 'w') as f:
+        f.writelines(store.names[i] + '\n' for i in rows)
+    del store
+    os.replace(vectors_path + '.tmp', vectors_path)
+    os.replace(names_path + '.tmp', names_path)
+    return dropped
+
+
+def convert_directory(embeddings_dir, store_dir, chunk_size=4096):
+    """Pack a directory of per-tile .npy embeddings into an embedding store"""
+    filenames = sorted(filename for filename in os.listdir(embeddings_dir) if filename.endswith('.npy'))
+    n = len(filenames)
+
+    with EmbeddingWriter(store_dir, chunk_size=chunk_size) as writer:
+        print() # print an empty new line
+        for i, filename in enumerate(filenames):
+            if i % 1000 == 0:
+                print('\rConverting embeddings {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+            emb = np.load(os.path.join(embeddings_dir, filename))
+            writer.append([filename], emb.reshape(1, -1))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('embeddings_dir')
+    parser.add_argument('store_dir')
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    args = parser.parse_args()
+
+    convert_directory(args.embeddings_dir, args.store_dir, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import time
+
+import numpy as np
+from imageio import imwrite
+
+from .wrangle import cat_to_display_batch
+from .shards import open_tiles
+
+
+def lerp_path(a, b, n=10):
+    """Borders of the n equal intervals from a to b, n + 1 points"""
+    t = np.linspace(0, 1, n + 1)[:, np.newaxis]
+    return a * (1 - t) + b * t
+
+
+def sweep_path(a, dimension, step, n=11):
+    """n points moving a along one latent dimension, step further at each point"""
+    path = np.repeat(a.reshape(1, -1), n, axis=0)
+    path[:, dimension] += step * np.arange(n)
+    return path
+
+
+def random_walk(a, n=11, scale=1.0, random_state=None):
+    """n points of a gaussian random walk starting at a"""
+    rng = np.random.RandomState(random_state)
+    steps = rng.randn(n - 1, a.size) * scale
+    return a.reshape(1, -1) + np.vstack([np.zeros((1, a.size)), np.cumsum(steps, axis=0)])
+
+
+class AnchorEncodings:
+    """Encodings of anchor tiles, each tile only encoded once, in batched session calls"""
+
+    def __init__(self, encoder, tiles_dir, batch_size=64):
+        self.encoder = encoder
+        self.tiles = open_tiles(tiles_dir)
+        self.batch_size = batch_size
+        self.encodings = {}
+
+    def encode(self, names):
+        missing = [name for name in dict.fromkeys(names) if name not in self.encodings]
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            embs = self.encoder.encode_batch([self.tiles.read_png(name) for name in batch])
+            self.encodings.update(zip(batch, np.asarray(embs).reshape(len(batch), -1)))
+
+    def __getitem__(self, name):
+        self.encode([name])
+        return self.encodings[name]
+
+
+class Traversal:
+    """Many latent paths through the anchor encodings of one model, decoded together.
+
+    anchors is an AnchorEncodings, which can be shared between traversals. Paths are (n_points, D) arrays,
+    e.g. from lerp_path, sweep_path or random_walk. The points of all paths are decoded in batches
+    of batch_size per session call, instead of one call per point
+    """
+
+    def __init__(self, anchors, decoder, colors, reverse=False, batch_size=256):
+        self.anchors = anchors
+        self.decoder = decoder
+        self.colors = colors
+        self.reverse = reverse
+        self.batch_size = batch_size
+        self.paths = []
+
+    def lerp(self, name1, name2, n=10):
+        self.anchors.encode([name1, name2])
+        return self.add(lerp_path(self.anchors[name1], self.anchors[name2], n))
+
+    def sweep(self, name, dimension, step, n=11):
+        return self.add(sweep_path(self.anchors[name], dimension, step, n))
+
+    def walk(self, name, n=11, scale=1.0, random_state=None):
+        return self.add(random_walk(self.anchors[name], n, scale, random_state))
+
+    def add(self, path):
+        self.paths.append(np.asarray(path, dtype=np.float32))
+        return len(self.paths) - 1
+
+    def decode(self):
+        """Decode every path added so far, returns a list of lists of display images, one list per path"""
+        start = time.time()
+        points = np.vstack(self.paths)
+        images = []
+        for i in range(0, len(points), self.batch_size):
+            decoded = self.decoder.decode_batch(points[i:i + self.batch_size])
+            images.extend(cat_to_display_batch(decoded, self.colors, self.reverse))
+        print('decoded {} paths of {} points in {:.1f}s'.format(len(self.paths), len(points), time.time() - start))
+
+        offsets = np.cumsum([0] + [len(path) for path in self.paths])
+        self.paths = []
+        return [images[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def strip(images):
+    """Images of a path side by side"""
+    return np.hstack(images)
+
+
+def sprite_sheet(paths):
+    """One row per path, shorter paths padded with black"""
+    width = max(len(images) for images in paths)
+    blank = np.zeros_like(paths[0][0])
+    return np.vstack([strip(list(images) + [blank] * (width - len(images))) for images in paths])
+
+
+def save_strips(paths, output_dir, names=None):
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        pass
+    for i, images in enumerate(paths):
+        imwrite(os.path.join(output_dir, (names[i] if names else str(i + 1)) + '.png'), strip(images))
+
+
+def save_sprite_sheet(paths, output_path, rows_per_sheet=None):
+    """Write all paths as one sprite sheet, or as several of rows_per_sheet rows each, numbered output_path_<i>.png"""
+    if rows_per_sheet is None or len(paths) <= rows_per_sheet:
+        imwrite(output_path, sprite_sheet(paths))
+        return
+    root, ext = os.path.splitext(output_path)
+    for i in range(0, len(paths), rows_per_sheet):
+        imwrite('{}_{}{}'.format(root, i // rows_per_sheet + 1, ext), sprite_sheet(paths[i:i + rows_per_sheet]))
@@ -0,0 +1,57 @@
+import os
+import threading
+
+from .embedstore import tile_name
+
+MANIFEST_FILE = 'manifest.tsv'
+
+
+class Manifest:
+    """Append-only record of processed tiles: tile name, input file size and mtime, and model version.
+
+    A tile needs (re)processing if it has no entry, or if its input file or the model changed
+    since the entry was written. Later entries for the same tile replace earlier ones
+    """
+
+    def __init__(self, path, model_version):
+        self.path = path
+        self.model_version = model_version
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4:
+                        # partially written last line of an interrupted run
+                        continue
+                    name, size, mtime, version = fields
+                    self.entries[name] = (int(size), int(mtime), version)
+
+    def pending(self, filenames, stat):
+        """Filter filenames down to the tiles which are new or changed since they were last recorded.
+
+        stat returns the (size, mtime) of a tile's input, see shards.TileDirectory and shards.ShardReader
+        """
+        result = []
+        for filename in filenames:
+            name = tile_name(filename)
+            size, mtime = stat(filename)
+            self.stats[name] = (size, mtime)
+            if self.entries.get(name) != (size, mtime, self.model_version):
+                result.append(filename)
+        return result
+
+    def record(self, filenames):
+        """Mark tiles as processed, using the input file stats taken by pending()"""
+        lines = []
+        with self.lock:
+            for filename in filenames:
+                name = tile_name(filename)
+                size, mtime = self.stats[name]
+                self.entries[name] = (size, mtime, self.model_version)
+                lines.append('{}\t{}\t{}\t{}\n'.format(name, size, mtime, self.model_version))
+            with open(self.path, 'a') as f:
+                f.writelines(lines)
@@ -0,0 +1,117 @@
+import time
+import threading
+from queue import Queue
+
+from .shards import open_tiles
+from .usemodel import (batches, select_tiles, select_reconstructions, decode_selected, open_embed_output,
+                       close_embed_output, save_embeddings, save_reconstructions, print_throughput)
+
+_DONE = object()
+
+
+class Stage:
+    """A pool of worker threads consuming items from in_queue and putting the results on out_queue.
+
+    If any worker fails, the remaining items are drained without processing so that the upstream
+    stages never block on a full queue, and the first error is re-raised by join()
+    """
+
+    def __init__(self, fn, n_workers, in_queue, out_queue=None, errors=None):
+        self.fn = fn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.errors = errors if errors is not None else []
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(n_workers)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+        return self
+
+    def _work(self):
+        while True:
+            item = self.in_queue.get()
+            if item is _DONE:
+                # put the sentinel back for the sibling workers
+                self.in_queue.put(_DONE)
+                return
+            if self.errors:
+                continue
+            try:
+                res = self.fn(item)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            if self.out_queue is not None:
+                self.out_queue.put(res)
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        if self.out_queue is not None:
+            self.out_queue.put(_DONE)
+
+
+def use_model_pipelined(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, result_colors,
+                        reverse=False, batch_size=64, readers=4, writers=4, queue_size=8, embed_store=False,
+                        incremental=False, reconstructions='all', reconstruction_n=1, tile_filter=None):
+    """Same output as usemodel.use_model, but overlaps disk reads, session execution and colorizing/writing.
+
+    Tiles flow through bounded queues (queue_size batches each) between a pool of reader threads,
+    a single inference thread running the encoder and decoder, and a pool of writer threads
+    """
+
+    tiles = open_tiles(input_dir)
+    filenames, manifest = select_tiles(encoder, tiles, embed_output_dir, incremental, tile_filter)
+    n = len(filenames)
+    selected = select_reconstructions(filenames, reconstructions, reconstruction_n)
+
+    embed_output = open_embed_output(embed_output_dir, embed_store, manifest)
+
+    errors = []
+    job_queue = Queue(queue_size)
+    read_queue = Queue(queue_size)
+    write_queue = Queue(queue_size)
+
+    lock = threading.Lock()
+    progress = {'done': 0}
+    start = time.time()
+
+    def read(batch):
+        return batch, [tiles.read_png(filename) for filename in batch]
+
+    def infer(item):
+        batch, imgs = item
+        embs = encoder.encode_batch(imgs)
+        recon_filenames, ims = decode_selected(decoder, batch, embs, selected)
+        return batch, embs, recon_filenames, ims
+
+    def write(item):
+        batch, embs, recon_filenames, ims = item
+        save_embeddings(embed_output, batch, embs, manifest)
+        save_reconstructions(reconstruction_output_dir, recon_filenames, ims, result_colors, reverse)
+        with lock:
+            progress['done'] += len(batch)
+            done = progress['done']
+        elapsed = time.time() - start
+        print('\rProcessed {} of {} tiles ({:.1f} tiles/s)'.format(done, n, done / elapsed if elapsed > 0 else 0), end='')
+
+    read_stage = Stage(read, readers, job_queue, read_queue, errors).start()
+    infer_stage = Stage(infer, 1, read_queue, write_queue, errors).start()
+    write_stage = Stage(write, writers, write_queue, None, errors).start()
+
+    for batch in batches(filenames, batch_size):
+        job_queue.put(batch)
+    job_queue.put(_DONE)
+
+    read_stage.join()
+    infer_stage.join()
+    write_stage.join()
+    print()
+
+    close_embed_output(embed_output)
+
+    if errors:
+        raise errors[0]
+
+    print_throughput(n, start, batch_size)
@@ -0,0 +1,516 @@
+import os
+import re
+import json
+import gzip
+import time
+import struct
+import sqlite3
+import argparse
+import colorsys
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from .download import STYLES, read_tile_list, tile_filename, DirectoryOutput, ShardOutput
+from .wrangle import alpha_composite, imgs_to_ndarr
+from .shards import array_to_png
+
+TILESERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tileserver')
+STYLE_FILE = 'gan-plan-{}.json'
+GEOMETRY_TYPES = {1: 'Point', 2: 'LineString', 3: 'Polygon'}
+
+
+# minimal protobuf and Mapbox vector tile decoding, only what the styles need
+
+def _varint(buf, i):
+    result = shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, i
+        shift += 7
+
+
+def _fields(buf):
+    """(field number, wire type, value) of every field of a protobuf message, length delimited values as slices"""
+    i, n = 0, len(buf)
+    while i < n:
+        key, i = _varint(buf, i)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = _varint(buf, i)
+        elif wire == 2:
+            length, i = _varint(buf, i)
+            value = buf[i:i + length]
+            i += length
+        elif wire == 1:
+            value = buf[i:i + 8]
+            i += 8
+        elif wire == 5:
+            value = buf[i:i + 4]
+            i += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire))
+        yield field, wire, value
+
+
+def _packed(value, wire):
+    if wire == 0:
+        return [value]
+    values, i = [], 0
+    while i < len(value):
+        v, i = _varint(value, i)
+        values.append(v)
+    return values
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _value(buf):
+    for field, wire, value in _fields(buf):
+        if field == 1:
+            return bytes(value).decode('utf-8')
+        elif field == 2:
+            return struct.unpack('<f', value)[0]
+        elif field == 3:
+            return struct.unpack('<d', value)[0]
+        elif field == 4:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        elif field == 5:
+            return value
+        elif field == 6:
+            return _zigzag(value)
+        elif field == 7:
+            return bool(value)
+    return None
+
+
+def _geometry(commands):
+    """Lines, rings or points of a feature as (n, 2) arrays of tile coordinates, rings closed"""
+    parts, part = [], None
+    x = y = 0
+    i = 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if command == 7:
+            if part:
+                part.append(part[0])
+            continue
+        for _ in range(count):
+            x += _zigzag(commands[i])
+            y += _zigzag(commands[i + 1])
+            i += 2
+            if command == 1:
+                part = [(x, y)]
+                parts.append(part)
+            else:
+                part.append((x, y))
+    return [np.array(part, dtype=np.float64) for part in parts]
+
+
+def _feature(buf, keys, values):
+    tags, geom_type, commands = [], 0, []
+    for field, wire, value in _fields(buf):
+        if field == 2:
+            tags.extend(_packed(value, wire))
+        elif field == 3:
+            geom_type = value
+        elif field == 4:
+            commands.extend(_packed(value, wire))
+    properties = {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])}
+    return geom_type, properties, _geometry(commands)
+
+
+def decode_tile(data, layer_names=None):
+    """Layers of a vector tile as {name: (extent, [(geometry type, properties, parts)])}, only layer_names if given"""
+    layers = {}
+    for field, _, layer in _fields(memoryview(data)):
+        if field != 3:
+            continue
+        name, extent, keys, values, features = None, 4096, [], [], []
+        for f, _, value in _fields(layer):
+            if f == 1:
+                name = bytes(value).decode('utf-8')
+            elif f == 2:
+                features.append(value)
+            elif f == 3:
+                keys.append(bytes(value).decode('utf-8'))
+            elif f == 4:
+                values.append(_value(value))
+            elif f == 5:
+                extent = value
+        if layer_names is None or name in layer_names:
+            layers[name] = (extent, [_feature(feature, keys, values) for feature in features])
+    return layers
+
+
+class MBTiles:
+    """Vector tiles of an .mbtiles file, read straight from its SQLite database.
+
+    Tiles above the maximum zoom of the file, e.g. z15 from OpenMapTiles' z14, are cut out of their ancestor,
+    the last cache_size decoded ancestors are kept so that sibling tiles only decode it once
+    """
+
+    def __init__(self, path, cache_size=16):
+        if not os.path.exists(path):
+            raise IOError('no such mbtiles file: {}'.format(path))
+        self.connection = sqlite3.connect(path)
+        metadata = dict(self.connection.execute('SELECT name, value FROM metadata'))
+        self.maxzoom = int(metadata.get('maxzoom', 14))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def read(self, zoom, col, row):
+        """Uncompressed vector tile data, None if the file does not have the tile"""
+        # mbtiles rows are numbered from the south, TMS style
+        result = self.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                         (zoom, col, (1 << zoom) - 1 - row)).fetchone()
+        if result is None:
+            return None
+        data = bytes(result[0])
+        return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+    def _decoded(self, zoom, col, row, layer_names):
+        key = (zoom, col, row)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        data = self.read(zoom, col, row)
+        layers = decode_tile(data, layer_names) if data is not None else {}
+        self.cache[key] = layers
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return layers
+
+    def features(self, tile, layer_names, size, margin=0):
+        """Features of layer_names in tile, with parts in pixel coordinates of a size x size image,
+        parts further than margin pixels outside the tile are left out
+        """
+        col, row, zoom = tile
+        source_zoom = min(zoom, self.maxzoom)
+        dz = zoom - source_zoom
+        layers = self._decoded(source_zoom, col >> dz, row >> dz, layer_names)
+
+        offset = np.array([col - ((col >> dz) << dz), row - ((row >> dz) << dz)], dtype=np.float64) * size
+        features = {}
+        for name, (extent, layer_features) in layers.items():
+            scale = size * (1 << dz) / extent
+            selected = []
+            for geom_type, properties, parts in layer_features:
+                pixels = []
+                for part in parts:
+                    part = part * scale - offset
+                    lo, hi = part.min(axis=0), part.max(axis=0)
+                    if hi[0] >= -margin and hi[1] >= -margin and lo[0] <= size + margin and lo[1] <= size + margin:
+                        pixels.append(part)
+                    elif geom_type == 3:
+                        # holes and islands are drawn in order, keep them as empty parts to keep the ring order
+                        pixels.append(None)
+                if any(part is not None for part in pixels):
+                    selected.append((geom_type, properties, pixels))
+            features[name] = selected
+        return features
+
+
+# the subset of the Mapbox GL style spec used by the gan-plan styles
+
+def parse_color(color):
+    """(r, g, b) in 0..255 and opacity in 0..1 of a #rgb, #rrggbb, rgb(), rgba(), hsl() or hsla() style colour"""
+    color = color.strip()
+    if color.startswith('#'):
+        digits = color[1:]
+        if len(digits) in (3, 4):
+            digits = ''.join(c * 2 for c in digits)
+        rgb = tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+        return rgb, int(digits[6:8], 16) / 255.0 if len(digits) == 8 else 1.0
+
+    name, args = re.match(r'(\w+)\((.*)\)', color).groups()
+    args = [arg.strip() for arg in args.split(',')]
+    alpha = float(args[3]) if len(args) == 4 else 1.0
+    if name in ('rgb', 'rgba'):
+        return tuple(int(round(float(arg))) for arg in args[:3]), alpha
+    elif name in ('hsl', 'hsla'):
+        h, s, l = float(args[0]) / 360, float(args[1].rstrip('%')) / 100, float(args[2].rstrip('%')) / 100
+        return tuple(int(round(c * 255)) for c in colorsys.hls_to_rgb(h, l, s)), alpha
+    raise ValueError('unsupported colour {}'.format(color))
+
+
+def style_value(value, zoom):
+    """A constant or a zoom function with stops and an exponential base"""
+    if not isinstance(value, dict):
+        return value
+    stops = value['stops']
+    base = value.get('base', 1)
+    if zoom <= stops[0][0]:
+        return stops[0][1]
+    for (z0, v0), (z1, v1) in zip(stops[:-1], stops[1:]):
+        if zoom <= z1:
+            if base == 1:
+                t = (zoom - z0) / (z1 - z0)
+            else:
+                t = (base ** (zoom - z0) - 1) / (base ** (z1 - z0) - 1)
+            return v0 + (v1 - v0) * t
+    return stops[-1][1]
+
+
+def matches(layer_filter, geom_type, properties):
+    """Whether a feature passes a legacy (pre expressions) style filter"""
+    if layer_filter is None:
+        return True
+    op = layer_filter[0]
+    if op == 'all':
+        return all(matches(f, geom_type, properties) for f in layer_filter[1:])
+    elif op == 'any':
+        return any(matches(f, geom_type, properties) for f in layer_filter[1:])
+    elif op == 'none':
+        return not any(matches(f, geom_type, properties) for f in layer_filter[1:])
+
+    key = layer_filter[1]
+    if op in ('has', '!has'):
+        return (key == '$type' or key in properties) == (op == 'has')
+    value = GEOMETRY_TYPES.get(geom_type) if key == '$type' else properties.get(key)
+    if op == '==':
+        return value == layer_filter[2]
+    elif op == '!=':
+        return value != layer_filter[2]
+    elif op == 'in':
+        return value in layer_filter[2:]
+    elif op == '!in':
+        return value not in layer_filter[2:]
+    elif op in ('<', '<=', '>', '>='):
+        if value is None:
+            return False
+        return {'<': value < layer_filter[2], '<=': value <= layer_filter[2],
+                '>': value > layer_filter[2], '>=': value >= layer_filter[2]}[op]
+    raise ValueError('unsupported filter {}'.format(op))
+
+
+class Style:
+    """The background, fill and line layers of a style, the only layer types the gan-plan styles use"""
+
+    def __init__(self, path):
+        with open(path) as f:
+            style = json.load(f)
+        self.name = style.get('name')
+        self.layers = [layer for layer in style['layers'] if layer['type'] in ('background', 'fill', 'line')
+                       and layer.get('layout', {}).get('visibility', 'visible') != 'none']
+        self.source_layers = set(layer['source-layer'] for layer in self.layers if 'source-layer' in layer)
+
+    def max_line_width(self, zoom):
+        return max([style_value(layer.get('paint', {}).get('line-width', 1), zoom) for layer in self.layers
+                    if layer['type'] == 'line'] or [0])
+
+
+def load_styles(names, styles_dir=os.path.join(TILESERVER_DIR, 'styles')):
+    return {name: Style(os.path.join(styles_dir, STYLE_FILE.format(name))) for name in names}
+
+
+def _ring_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) / 2
+
+
+def _fill_polygon(mask, draw, rings):
+    rings = [ring for ring in rings if ring is None or len(ring) > 2]
+    if len(rings) == 1 and rings[0] is not None:
+        draw.polygon(rings[0].ravel().tolist(), fill=255)
+        return
+    # exterior rings are clockwise on screen, each followed by its holes, so drawing in order gets the holes right
+    feature = Image.new('L', mask.size)
+    feature_draw = ImageDraw.Draw(feature)
+    for ring in rings:
+        if ring is not None:
+            feature_draw.polygon(ring.ravel().tolist(), fill=255 if _ring_area(ring) > 0 else 0)
+    mask.paste(255, mask=feature)
+
+
+def _extend(line, d):
+    """Line lengthened by d at both ends, for square caps"""
+    line = line.copy()
+    for end, previous in ((0, 1), (-1, -2)):
+        direction = line[end] - line[previous]
+        length = np.hypot(*direction)
+        if length > 0:
+            line[end] += direction / length * d
+    return line
+
+
+def _draw_line(draw, line, width, cap='butt', join='miter'):
+    if cap == 'square':
+        line = _extend(line, width / 2)
+    draw.line(line.ravel().tolist(), fill=255, width=max(1, int(round(width))), joint='curve' if join == 'round' else None)
+    if cap == 'round' and width > 2:
+        r = width / 2
+        for x, y in (line[0], line[-1]):
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=255)
+
+
+def render_style(style, features, zoom, tile_size=256, supersample=2):
+    """RGBA tile of a style, as tileserver-gl renders it, from features in pixel coordinates of the supersampled tile.
+
+    tileserver-gl renders 256 pixel tiles at zoom - 1 with 512 pixel tiles, so zoom functions are evaluated there.
+    Layers are drawn as coverage masks supersample times larger, averaged down for anti-aliasing, and composited
+    in order with their colour and opacity
+    """
+    style_zoom = zoom + np.log2(tile_size / 512.0)
+    size = tile_size * supersample
+    canvas = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+
+    for layer in style.layers:
+        if not layer.get('minzoom', 0) <= style_zoom < layer.get('maxzoom', 24):
+            continue
+        paint = layer.get('paint', {})
+        kind = layer['type']
+        color, alpha = parse_color(paint.get(kind + '-color', '#000'))
+        opacity = style_value(paint.get(kind + '-opacity', 1), style_zoom) * alpha
+
+        if kind == 'background':
+            coverage = np.ones((tile_size, tile_size))
+        else:
+            selected = [feature for feature in features.get(layer['source-layer'], ())
+                        if matches(layer.get('filter'), feature[0], feature[1])]
+            if not selected:
+                continue
+            mask = Image.new('L', (size, size))
+            draw = ImageDraw.Draw(mask)
+            if kind == 'fill':
+                for geom_type, _, parts in selected:
+                    if geom_type == 3:
+                        _fill_polygon(mask, draw, parts)
+            else:
+                width = style_value(paint.get('line-width', 1), style_zoom) * supersample
+                layout = layer.get('layout', {})
+                for geom_type, _, parts in selected:
+                    if geom_type in (2, 3):
+                        for part in parts:
+                            if part is not None and len(part) > 1:
+                                _draw_line(draw, part, width, layout.get('line-cap', 'butt'), layout.get('line-join', 'miter'))
+            coverage = np.asarray(mask, dtype=np.float64).reshape(tile_size, supersample, tile_size, supersample).mean(axis=(1, 3)) / 255
+
+        rgba = np.empty((tile_size, tile_size, 4), dtype=np.uint8)
+        rgba[..., :3] = color
+        rgba[..., 3] = np.round(coverage * opacity * 255)
+        canvas = alpha_composite(canvas, rgba)
+    return canvas
+
+
+def rasterize_tile(source, styles, tile, tile_size=256, supersample=2):
+    """RGBA image of every style of a tile, {style name: array}"""
+    style_zoom = tile[2] + np.log2(tile_size / 512.0)
+    layer_names = set().union(*(style.source_layers for style in styles.values()))
+    margin = max(style.max_line_width(style_zoom) for style in styles.values()) * supersample
+    features = source.features(tile, layer_names, tile_size * supersample, margin)
+    return {name: render_style(style, features, tile[2], tile_size, supersample) for name, style in styles.items()}
+
+
+# mbtiles source and styles, opened once in every worker process by the pool initializer
+_source = None
+_styles = None
+_options = None
+
+
+def _init_worker(mbtiles_path, styles_dir, style_names, channel_defs, tile_size, supersample):
+    global _source, _styles, _options
+    _source = MBTiles(mbtiles_path)
+    _styles = load_styles(style_names, styles_dir)
+    _options = dict(channel_defs=channel_defs, tile_size=tile_size, supersample=supersample)
+
+
+def _rasterize(job):
+    tile, style_names = job
+    try:
+        # only the styles not in the output yet, all of them for categorical tiles
+        styles = _styles if style_names is None else {name: _styles[name] for name in style_names}
+        images = rasterize_tile(_source, styles, tile, _options['tile_size'], _options['supersample'])
+        if _options['channel_defs'] is not None:
+            # fused split-cat, only the categorical tile leaves the worker
+            cat = imgs_to_ndarr(*[(images[style], channel) for style, channel in _options['channel_defs']])
+            return tile, {None: array_to_png(cat)}, None
+        return tile, {style: array_to_png(arr) for style, arr in images.items()}, None
+    except Exception as e:
+        return tile, None, e
+
+
+def rasterize_tiles(tiles, styles, output, mbtiles_path=os.path.join(TILESERVER_DIR, 'europe.mbtiles'),
+                    styles_dir=os.path.join(TILESERVER_DIR, 'styles'), channel_defs=None, workers=os.cpu_count(),
+                    chunk_size=16, tile_size=256, supersample=2):
+    """Offline equivalent of download.download_tiles, or of download_cat_tiles with channel_defs: every style of
+    every tile which is not in output yet, rendered from the vector tiles of mbtiles_path by a pool of worker processes.
+    Returns the list of failed tiles
+    """
+    if channel_defs is not None:
+        styles = sorted(set(style for style, _ in channel_defs))
+        jobs = [(tile, None) for tile in tiles if not output.exists(None, tile)]
+    else:
+        jobs = [(tile, [style for style in styles if not output.exists(style, tile)]) for tile in tiles]
+        jobs = [job for job in jobs if job[1]]
+    n = len(jobs)
+    print('{} of {} tiles to rasterize'.format(n, len(tiles)))
+
+    # tiles cut from the same ancestor go to the same worker, which decodes it once
+    dz = max(0, max([tile[2] for tile, _ in jobs] or [0]) - MBTiles(mbtiles_path).maxzoom)
+    jobs.sort(key=lambda job: (job[0][2], job[0][1] >> dz, job[0][0] >> dz, job[0][1], job[0][0]))
+
+    start = time.time()
+    failed = []
+    pool = Pool(workers, _init_worker, (mbtiles_path, styles_dir, styles, channel_defs, tile_size, supersample))
+    try:
+        print() # print an empty new line
+        for i, (tile, pngs, error) in enumerate(pool.imap_unordered(_rasterize, jobs, chunk_size)):
+            if error is not None:
+                failed.append(tile)
+                print('\nFailed {}: {}'.format(tile_filename(tile), error))
+            else:
+                for style, data in pngs.items():
+                    output.write(style, tile, data)
+            if i % 100 == 0:
+                print('\rRasterizing tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+    finally:
+        pool.close()
+        pool.join()
+        output.close()
+    print()
+
+    elapsed = time.time() - start
+    print('{} tiles rasterized, {} failed, in {:.1f}s ({:.1f} tiles/s with {} workers)'.format(
+        n - len(failed), len(failed), elapsed, (n - len(failed)) / elapsed if elapsed > 0 else 0, workers))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tile_list')
+    parser.add_argument('output_directory')
+    parser.add_argument('-t', '--types', nargs='*', default=list(STYLES))
+    parser.add_argument('-m', '--mbtiles', default=os.path.join(TILESERVER_DIR, 'europe.mbtiles'))
+    parser.add_argument('--styles-dir', default=os.path.join(TILESERVER_DIR, 'styles'))
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=16)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--supersample', type=int, default=2)
+    parser.add_argument('--shards', action='store_true', default=False)
+    parser.add_argument('--cat', action='store_true', default=False)
+    parser.add_argument('-x', '--channels', type=int, nargs='*')
+    args = parser.parse_args()
+
+    if args.cat and (args.channels is None or len(args.types) != len(args.channels)):
+        raise ValueError('Need the same number of channel definitions as types')
+
+    tiles = read_tile_list(args.tile_list, args.start)
+    output = ShardOutput(args.output_directory) if args.shards else DirectoryOutput(args.output_directory)
+    channel_defs = list(zip(args.types, args.channels)) if args.cat else None
+
+    rasterize_tiles(tiles, args.types, output, args.mbtiles, args.styles_dir, channel_defs, args.workers,
+                    args.chunk_size, args.tile_size, args.supersample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import os
+import json
+import zlib
+import argparse
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from .embedstore import tile_name
+
+SHARD_META = 'shards.json'
+SHARD_INDEX = 'index.tsv'
+COMPRESSIONS = ('png', 'zlib', 'raw')
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, SHARD_META))
+
+
+def shard_filename(i):
+    return 'shard-{:05d}.tiles'.format(i)
+
+
+def png_to_array(data):
+    img = Image.open(BytesIO(data))
+    if img.mode == 'P':
+        # expand palettes like imageio.imread does
+        img = img.convert('RGBA')
+    return np.array(img)
+
+
+def array_to_png(arr):
+    arr = np.asarray(arr, dtype=np.uint8)
+    if arr.ndim == 3 and arr.shape[2] == 1:
+        # single type categorical tiles, PIL only takes those as 2-D
+        arr = arr[:, :, 0]
+    buf = BytesIO()
+    Image.fromarray(arr).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _read_index(shard_dir):
+    index = {}
+    index_path = os.path.join(shard_dir, SHARD_INDEX)
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                # partially written last line of an interrupted run
+                continue
+            name, shard, offset, length, shape = fields
+            shape = tuple(int(x) for x in shape.split('x')) if shape else None
+            index[name] = (int(shard), int(offset), int(length), shape)
+    return index
+
+
+class ShardWriter:
+    """Packs tiles into a few large shard files plus an index of tile name -> (shard, offset, length, shape).
+
+    Tiles are stored as PNG bytes, zlib compressed or raw uint8 arrays. New tiles always go to new shards,
+    so appending to an existing shard set never rewrites data, and re-added tiles replace their older copy
+    """
+
+    def __init__(self, output_dir, compression='png', shard_bytes=1 << 30):
+        if compression not in COMPRESSIONS:
+            raise ValueError('invalid compression, expected one of {}'.format(COMPRESSIONS))
+
+        self.output_dir = output_dir
+        self.shard_bytes = shard_bytes
+
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            pass
+
+        if is_shard_dir(output_dir):
+            with open(os.path.join(output_dir, SHARD_META)) as f:
+                meta = json.load(f)
+            if meta['compression'] != compression:
+                raise ValueError('Shards in {} use {} compression, cannot append {}'.format(output_dir, meta['compression'], compression))
+            self.shard = meta['shards']
+        else:
+            self.shard = 0
+        self.compression = compression
+
+        self.shard_file = None
+        self.offset = 0
+        self.pending_index = []
+
+    def _write_meta(self):
+        with open(os.path.join(self.output_dir, SHARD_META), 'w') as f:
+            json.dump({'compression': self.compression, 'shards': self.shard}, f)
+
+    def _encode(self, data):
+        if isinstance(data, bytes):
+            if self.compression == 'png':
+                return data, None
+            data = png_to_array(data)
+        arr = np.asarray(data, dtype=np.uint8)
+        if self.compression == 'png':
+            return array_to_png(arr), None
+        raw = arr.tobytes()
+        return zlib.compress(raw) if self.compression == 'zlib' else raw, arr.shape
+
+    def add(self, name, data):
+        """Add a tile, given either as an array or as PNG file contents"""
+        record, shape = self._encode(data)
+
+        if self.shard_file is None or (self.offset > 0 and self.offset + len(record) > self.shard_bytes):
+            self._next_shard()
+
+        self.shard_file.write(record)
+        self.pending_index.append('{}\t{}\t{}\t{}\t{}\n'.format(tile_name(name), self.shard - 1, self.offset, len(record),
+                                                                'x'.join(str(x) for x in shape) if shape else ''))
+        self.offset += len(record)
+        if len(self.pending_index) >= 1024:
+            self._flush_index()
+
+    def _flush_index(self):
+        # the data goes to disk before the index entries pointing at it
+        self.shard_file.flush()
+        with open(os.path.join(self.output_dir, SHARD_INDEX), 'a') as f:
+            f.writelines(self.pending_index)
+        self.pending_index = []
+
+    def _next_shard(self):
+        if self.shard_file is not None:
+            self._flush_index()
+            self.shard_file.close()
+        self.shard_file = open(os.path.join(self.output_dir, shard_filename(self.shard)), 'wb')
+        self.shard += 1
+        self.offset = 0
+        self._write_meta()
+
+    def close(self):
+        if self.shard_file is not None:
+            self._flush_index()
+            self.shard_file.close()
+            self.shard_file = None
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """Random access by tile name and sequential streaming over a shard set"""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SHARD_META)) as f:
+            meta = json.load(f)
+        self.compression = meta['compression']
+        self.index = _read_index(shard_dir)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return tile_name(name) in self.index
+
+    @property
+    def names(self):
+        return list(self.index.keys())
+
+    def filenames(self):
+        return [name + '.png' for name in self.index]
+
+    def _shard_path(self, shard):
+        return os.path.join(self.shard_dir, shard_filename(shard))
+
+    def _map(self, shard):
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(self._shard_path(shard), dtype=np.uint8, mode='r')
+        return self.maps[shard]
+
+    def _decode(self, record, shape):
+        if self.compression == 'png':
+            return png_to_array(record)
+        if self.compression == 'zlib':
+            record = zlib.decompress(record)
+        return np.frombuffer(record, dtype=np.uint8).reshape(shape)
+
+    def read_record(self, name):
+        shard, offset, length, shape = self.index[tile_name(name)]
+        return self._map(shard)[offset:offset + length].tobytes(), shape
+
+    def read(self, name):
+        return self._decode(*self.read_record(name))
+
+    def read_png(self, name):
+        """PNG file contents of a tile, as accepted by usemodel.Encoder"""
+        record, shape = self.read_record(name)
+        if self.compression == 'png':
+            return record
+        return array_to_png(self._decode(record, shape))
+
+    def stat(self, name):
+        shard, offset, length, shape = self.index[tile_name(name)]
+        return length, os.stat(self._shard_path(shard)).st_mtime_ns
+
+    def iter_records(self):
+        """Stream (name, record, shape) in storage order, reading each shard front to back"""
+        entries = sorted(self.index.items(), key=lambda item: item[1][:2])
+        current_shard, f = None, None
+        try:
+            for name, (shard, offset, length, shape) in entries:
+                if shard != current_shard:
+                    if f is not None:
+                        f.close()
+                    f = open(self._shard_path(shard), 'rb')
+                    current_shard = shard
+                if f.tell() != offset:
+                    # skip over replaced records
+                    f.seek(offset)
+                yield name, f.read(length), shape
+        finally:
+            if f is not None:
+                f.close()
+
+    def __iter__(self):
+        for name, record, shape in self.iter_records():
+            yield name, self._decode(record, shape)
+
+
+class TileDirectory:
+    """Directory of PNG tiles with the same interface as ShardReader"""
+
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+
+    def filenames(self):
+        return [filename for filename in os.listdir(self.input_dir) if filename.endswith('.png')]
+
+    def _path(self, name):
+        return os.path.join(self.input_dir, tile_name(name) + '.png')
+
+    def __contains__(self, name):
+        return os.path.exists(self._path(name))
+
+    def read(self, name):
+        return png_to_array(self.read_png(name))
+
+    def read_png(self, name):
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def stat(self, name):
+        st = os.stat(self._path(name))
+        return st.st_size, st.st_mtime_ns
+
+    def __iter__(self):
+        for filename in self.filenames():
+            yield tile_name(filename), self.read(filename)
+
+
+def open_tiles(path):
+    """Either a shard set or a plain directory of PNG tiles"""
+    return ShardReader(path) if is_shard_dir(path) else TileDirectory(path)
+
+
+def convert_directory(input_dir, output_dir, compression='png', shard_bytes=1 << 30):
+    """Pack a directory of PNG tiles, e.g. data/tiles/<name>, into a shard set"""
+    tiles = TileDirectory(input_dir)
+    filenames = sorted(tiles.filenames())
+    n = len(filenames)
+
+    with ShardWriter(output_dir, compression, shard_bytes) as writer:
+        print() # print an empty new line
+        for i, filename in enumerate(filenames):
+            if i % 1000 == 0:
+                print('\rPacking tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+            # PNG files go in as they are, no decoding needed
+            writer.add(filename, tiles.read_png(filename) if compression == 'png' else tiles.read(filename))
+    print()
+
+
+def convert_split_directory(input_root, output_root, types, compression='png', shard_bytes=1 << 30):
+    """Pack a split layout, e.g. france-ghs-split/<zoom>/<type>/, into one shard set per type"""
+    for t in types:
+        print('Packing', t)
+        convert_directory(os.path.join(input_root, t), os.path.join(output_root, t), compression, shard_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_directory')
+    parser.add_argument('output_directory')
+    parser.add_argument('-t', '--types', nargs='*')
+    parser.add_argument('-c', '--compression', choices=COMPRESSIONS, default='png')
+    parser.add_argument('--shard-size', type=int, default=1024, help='maximum shard size in MB')
+    args = parser.parse_args()
+
+    shard_bytes = args.shard_size << 20
+    if args.types:
+        convert_split_directory(args.input_directory, args.output_directory, args.types, args.compression, shard_bytes)
+    else:
+        convert_directory(args.input_directory, args.output_directory, args.compression, shard_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,101 @@
 import os
 import argparse
 from math import ceil
+from collections import OrderedDict
 
 import numpy as np
 from imageio import imread, imwrite
 from PIL import Image
 
+from .shards import open_tiles
+from .embedstore import tile_name
+
 
 def get_shifted_image(arr, col_shift, row_shift, neighbors):
-    
-    raise NotImplementedError('get_shifted_image is not implemented')
+    """Window of the size of arr, moved by col_shift tile widths to the right and row_shift tile heights down.
 
-    width, height, channels = arr.shape
+    neighbors maps (col, row) offsets from arr, as listed by get_tile_indices_for_shift, to the neighbouring
+    tile arrays, None or missing for tiles not in the tile set, which are left black
+    """
+    height, width = arr.shape[:2]
     indices_for_shift = get_tile_indices_for_shift(col_shift, row_shift)
-    # TODO finish
-    # selected_neighbors = [[] for ]
-
-    col_pixel_start = width if col_shift < 0 else 0
-    row_pixel_start = height if row_shift < 0 else 0
-
-    tiles_to_concat = []
-
-    col_index_shift = np.sign(col_shift) * ceil(abs(col_shift))
-    row_index_shift = np.sign(row_shift) * ceil(abs(row_shift))
-
-    col_index_lower_bound = min()
+    blank = np.zeros_like(arr)
+
+    rows = []
+    for row_indices in indices_for_shift:
+        tiles = [arr if index == (0, 0) else neighbors.get(index) for index in row_indices]
+        rows.append(np.concatenate([blank if tile is None else tile for tile in tiles], axis=1))
+    mosaic = np.concatenate(rows, axis=0)
+
+    # pixel offset of the window in the mosaic, whose top left tile is at the lowest offsets
+    min_col, min_row = indices_for_shift[0][0]
+    col_pixel_start = int(round(col_shift * width)) - min_col * width
+    row_pixel_start = int(round(row_shift * height)) - min_row * height
+    return mosaic[row_pixel_start:row_pixel_start + height, col_pixel_start:col_pixel_start + width]
+
+
+def parse_tile_name(name):
+    """zoom, col, row of a <zoom>_<col>_<row> tile name"""
+    zoom, col, row = (int(x) for x in tile_name(name).split('_'))
+    return zoom, col, row
+
+
+class TileMosaic:
+    """Windows of a tile set that straddle tile boundaries.
+
+    Decoded tiles are kept in an LRU cache of cache_size tiles, so that a scan over neighbouring windows,
+    e.g. a sliding window, reads each tile only once as long as the cache holds a row of the scan
+    """
+
+    def __init__(self, tiles, cache_size=256):
+        self.tiles = open_tiles(tiles) if isinstance(tiles, str) else tiles
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self.tile_shape = None
+
+    def read(self, zoom, col, row):
+        """Tile array, or None if the tile set does not have it"""
+        name = '{}_{}_{}'.format(zoom, col, row)
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            self.hits += 1
+            return self.cache[name]
+
+        self.misses += 1
+        arr = self.tiles.read(name) if name in self.tiles else None
+        if arr is not None and self.tile_shape is None:
+            self.tile_shape = (arr.shape, arr.dtype)
+        self.cache[name] = arr
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return arr
+
+    def get_shifted_image(self, name, col_shift, row_shift):
+        """Tile sized window moved col_shift tiles right and row_shift tiles down from tile name"""
+        zoom, col, row = parse_tile_name(name)
+        arr = self.read(zoom, col, row)
+        if arr is None:
+            raise KeyError(name)
+        neighbors = {(col_i, row_i): self.read(zoom, col + col_i, row + row_i)
+                     for row_indices in get_tile_indices_for_shift(col_shift, row_shift)
+                     for col_i, row_i in row_indices if (col_i, row_i) != (0, 0)}
+        return get_shifted_image(arr, col_shift, row_shift, neighbors)
+
+    def window(self, zoom, col, row):
+        """Tile sized window at fractional tile coordinates col, row, or None if it does not cover any tile of the set"""
+        base_col, base_row = int(np.floor(col)), int(np.floor(row))
+        col_shift, row_shift = float(col - base_col), float(row - base_row)
+        neighbors = {(col_i, row_i): self.read(zoom, base_col + col_i, base_row + row_i)
+                     for row_indices in get_tile_indices_for_shift(col_shift, row_shift)
+                     for col_i, row_i in row_indices}
+        if all(tile is None for tile in neighbors.values()):
+            return None
+        arr = neighbors.pop((0, 0))
+        if arr is None:
+            shape, dtype = self.tile_shape
+            arr = np.zeros(shape, dtype)
+        return get_shifted_image(arr, col_shift, row_shift, neighbors)
 
 
 sign = lambda x: (1, -1)[x < 0]
@@ -45,3 +116,15 @@ def get_tile_indices_for_shift(col_shift, row_shift):
     row_index_shift = symceil(row_shift)
 
     return [[(col_i, row_i) for col_i in sorted(inclusive_range(0, col_index_shift))] for row_i in sorted(inclusive_range(0, row_index_shift))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir')
+    parser.add_argument('name')
+    parser.add_argument('col_shift', type=float)
+    parser.add_argument('row_shift', type=float)
+    parser.add_argument('output_path')
+    args = parser.parse_args()
+
+    imwrite(args.output_path, TileMosaic(args.input_dir).get_shifted_image(args.name, args.col_shift, args.row_shift))
@@ -1,12 +1,188 @@
+import os
+import time
+import argparse
+from multiprocessing import Pool
+
 import numpy as np
-from imageio import imread, imwrite
-from PIL import Image
+
+from .shards import open_tiles
+from .embedstore import tile_name
+
+HISTOGRAM_BINS = 8
 
 
 def channel_coverage(arr):
+    # single channel categorical tiles are 2-D
+    arr = arr.reshape(arr.shape[0], arr.shape[1], -1)
     width, height, channels = arr.shape
 
     maximum_layer_value = width * height * 255.0
 
     return np.sum(arr, axis=(0,1)) / maximum_layer_value
 
+
+def channel_histogram(arr, bins=HISTOGRAM_BINS):
+    """Pixel counts of each channel in bins equal ranges of 0..255, as a (channels, bins) array"""
+    arr = arr.reshape(arr.shape[0], arr.shape[1], -1)
+    channels = arr.shape[2]
+    binned = arr.reshape(-1, channels).astype(np.int64) * bins // 256
+    offsets = np.arange(channels) * bins
+    return np.bincount((binned + offsets).ravel(), minlength=channels * bins).reshape(channels, bins)
+
+
+# tile sets of the scan and the channel taken from each, set in every worker process by the pool initializer
+_tiles = None
+_channel_defs = None
+
+
+def _init_worker(input_dir, channel_defs=None):
+    global _tiles, _channel_defs
+    if channel_defs is None:
+        _tiles = open_tiles(input_dir)
+    else:
+        _tiles = {type_name: open_tiles(os.path.join(input_dir, type_name)) for type_name, _ in channel_defs}
+    _channel_defs = channel_defs
+
+
+def _read(filename):
+    if _channel_defs is None:
+        return _tiles.read(filename)
+    # the categorical tile wrangle's split-cat mode makes of the type layers
+    return np.stack([_tiles[type_name].read(filename)[:, :, channel] for type_name, channel in _channel_defs], axis=2)
+
+
+def _scan_chunk(filenames):
+    arrs = [_read(filename) for filename in filenames]
+    return np.stack([channel_coverage(arr) for arr in arrs]), np.stack([channel_histogram(arr) for arr in arrs])
+
+
+class TileStats:
+    """Coverage and histogram of every channel of every tile of a tile set, keyed by tile name.
+
+    Stored as a single .npz of the sorted tile names, an (N, channels) float32 coverage table
+    and an (N, channels, bins) uint32 histogram table
+    """
+
+    def __init__(self, names, coverage, histograms):
+        self.names = np.asarray(names)
+        self.coverage = np.asarray(coverage, dtype=np.float32)
+        self.histograms = np.asarray(histograms, dtype=np.uint32)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['names'], f['coverage'], f['histograms'])
+
+    def save(self, path):
+        # ends in .npz, so that np.savez does not add it again
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, names=self.names, coverage=self.coverage, histograms=self.histograms)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return tile_name(name) in self.index
+
+    def rows(self, names):
+        return np.array([self.index[tile_name(name)] for name in names], dtype=np.int64)
+
+    def select(self, filenames, min_coverage=None, max_coverage=None, channels=None):
+        """The filenames whose coverage, summed over channels or all channels, is within [min_coverage, max_coverage],
+        either bound None for none. The sum can exceed 1 when several channels overlap. Tiles missing from the index are kept
+        """
+        min_coverage = -np.inf if min_coverage is None else min_coverage
+        max_coverage = np.inf if max_coverage is None else max_coverage
+        known = [filename for filename in filenames if filename in self]
+        coverage = self.coverage[self.rows(known)]
+        if channels is not None:
+            coverage = coverage[:, list(channels)]
+        coverage = coverage.sum(axis=1)
+        keep = set(np.asarray(known)[(coverage >= min_coverage) & (coverage <= max_coverage)])
+        return [filename for filename in filenames if filename in keep or filename not in self]
+
+
+def scan_tiles(input_dir, workers=os.cpu_count(), chunk_size=256, channel_defs=None):
+    """Coverage and histograms of every tile of a directory or shard set in one pass, read and computed
+    in chunks of chunk_size tiles by a pool of worker processes.
+
+    With (type, channel) channel_defs, input_dir is a split layout and the categorical tiles stacked from
+    its type directories are scanned, as wrangle's split-cat mode would write them
+    """
+    list_dir = input_dir if channel_defs is None else os.path.join(input_dir, channel_defs[0][0])
+    filenames = sorted(open_tiles(list_dir).filenames())
+    n = len(filenames)
+    chunks = [filenames[i:i + chunk_size] for i in range(0, n, chunk_size)]
+
+    start = time.time()
+    coverage, histograms = [], []
+    pool = Pool(workers, _init_worker, (input_dir, channel_defs)) if workers > 1 else None
+    try:
+        if pool is None:
+            _init_worker(input_dir, channel_defs)
+        results = pool.imap(_scan_chunk, chunks) if pool is not None else map(_scan_chunk, chunks)
+        print() # print an empty new line
+        done = 0
+        for chunk_coverage, chunk_histograms in results:
+            coverage.append(chunk_coverage)
+            histograms.append(chunk_histograms)
+            done += len(chunk_coverage)
+            print('\rScanning tiles {} of {} ({}% complete)'.format(done, n, int(done * 100 / n)), end='')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print()
+    print('scanned {} tiles in {:.1f}s with {} workers'.format(n, time.time() - start, workers))
+
+    return TileStats([tile_name(filename) for filename in filenames], np.concatenate(coverage), np.concatenate(histograms))
+
+
+def is_stale(stats, stats_path, input_dir, channel_defs=None):
+    """Whether the tiles of input_dir differ from the ones stats, saved at stats_path, were computed from or were written after it"""
+    stats_mtime = os.stat(stats_path).st_mtime_ns
+    directories = [input_dir] if channel_defs is None else [os.path.join(input_dir, type_name) for type_name, _ in channel_defs]
+    for directory in directories:
+        tiles = open_tiles(directory)
+        filenames = tiles.filenames()
+        if len(filenames) != len(stats) or not all(filename in stats for filename in filenames):
+            return True
+        if any(tiles.stat(filename)[1] > stats_mtime for filename in filenames):
+            return True
+    return False
+
+
+def coverage_filter(stats_path, input_dir, min_coverage=None, max_coverage=None, channels=None, workers=os.cpu_count(),
+                    channel_defs=None):
+    """Filter of tile filenames by coverage, for usemodel.select_tiles. Scans input_dir first if the index at stats_path
+    is missing or out of date"""
+    stats = TileStats.load(stats_path) if os.path.exists(stats_path) else None
+    if stats is None or is_stale(stats, stats_path, input_dir, channel_defs):
+        print('tile statistics at {} missing or out of date, scanning {}'.format(stats_path, input_dir))
+        stats = scan_tiles(input_dir, workers, channel_defs=channel_defs)
+        stats.save(stats_path)
+
+    def tile_filter(filenames):
+        selected = stats.select(filenames, min_coverage, max_coverage, channels)
+        print('{} of {} tiles within the coverage thresholds'.format(len(selected), len(filenames)))
+        return selected
+    return tile_filter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir')
+    parser.add_argument('output_path')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('-t', '--types', nargs='*', help='scan the split-cat tiles of these type directories of input_dir')
+    parser.add_argument('-x', '--channels', type=int, nargs='*')
+    args = parser.parse_args()
+
+    if args.types and (args.channels is None or len(args.types) != len(args.channels)):
+        raise ValueError('Need the same number of channel definitions as types')
+    channel_defs = list(zip(args.types, args.channels)) if args.types else None
+
+    scan_tiles(args.input_dir, args.workers, args.chunk_size, channel_defs).save(args.output_path)
@@ -0,0 +1,105 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from .download import TileClient, HTTPError, DirectoryOutput, ShardOutput, download_tiles, tile_filename
+from .shards import ShardReader, png_to_array, array_to_png
+
+# rows of the stub server's tiles: FLAKY_ROW fails twice before it succeeds, MISSING_ROW is always a 404
+# and DOWN_ROW always a 503
+FLAKY_ROW = 1
+MISSING_ROW = 2
+DOWN_ROW = 3
+
+
+def tile_array(tile):
+    col, row, zoom = tile
+    return np.full((4, 4, 3), col % 256, dtype=np.uint8)
+
+
+class StubTileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        # /styles/gan-plan-<style>/<zoom>/<col>/<row>.png
+        zoom, col, row = (int(x) for x in self.path[:-len('.png')].split('/')[-3:])
+        if row == MISSING_ROW:
+            self.reply(404, b'not found')
+        elif row == DOWN_ROW or (row == FLAKY_ROW and self.server.requests[self.path] <= 2):
+            self.reply(503, b'unavailable')
+        else:
+            self.reply(200, array_to_png(tile_array((col, row, zoom))))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubTileHandler)
+    httpd.requests = Counter()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def client_for(server, retries=3):
+    return TileClient('127.0.0.1:{}'.format(server.server_address[1]), retries=retries, backoff=0)
+
+
+def test_get_retries_server_errors(server):
+    data = client_for(server).get_tile('roads', (7, FLAKY_ROW, 15))
+    assert (png_to_array(data) == tile_array((7, FLAKY_ROW, 15))).all()
+    assert server.requests['/styles/gan-plan-roads/15/7/1.png'] == 3
+
+
+def test_get_gives_up_after_retries(server):
+    with pytest.raises(HTTPError) as e:
+        client_for(server, retries=2).get_tile('roads', (7, DOWN_ROW, 15))
+    assert e.value.status == 503
+    assert server.requests['/styles/gan-plan-roads/15/7/3.png'] == 3
+
+
+def test_get_does_not_retry_client_errors(server):
+    with pytest.raises(HTTPError) as e:
+        client_for(server).get_tile('roads', (7, MISSING_ROW, 15))
+    assert e.value.status == 404
+    assert server.requests['/styles/gan-plan-roads/15/7/2.png'] == 1
+
+
+@pytest.mark.parametrize('output_type', [DirectoryOutput, ShardOutput])
+def test_download_tiles_resumes(server, tmp_path, output_type):
+    styles = ['roads', 'water']
+    good = [(col, 0, 15) for col in range(10)] + [(10, FLAKY_ROW, 15)]
+    missing = (11, MISSING_ROW, 15)
+
+    failed = download_tiles(good + [missing], styles, output_type(str(tmp_path)), client_for(server), concurrency=4)
+    assert sorted(failed) == [(style, missing) for style in styles]
+
+    # a second run only asks for the tiles which failed
+    server.requests.clear()
+    failed = download_tiles(good + [missing], styles, output_type(str(tmp_path)), client_for(server), concurrency=4)
+    assert sorted(failed) == [(style, missing) for style in styles]
+    assert set(server.requests) == {'/styles/gan-plan-{}/15/11/2.png'.format(style) for style in styles}
+
+    for style in styles:
+        if output_type is ShardOutput:
+            reader = ShardReader(str(tmp_path / '15' / style))
+            assert len(reader) == len(good)
+            read = reader.read
+        else:
+            read = lambda filename: png_to_array((tmp_path / '15' / style / filename).read_bytes())
+        for tile in good:
+            assert (read(tile_filename(tile)) == tile_array(tile)).all()
@@ -1,4 +1,8 @@
 import os
+import time
+import random
+import hashlib
+import json
 
 import tensorflow as tf
 from tensorflow.python.saved_model import tag_constants
@@ -8,7 +12,11 @@ from PIL import Image
 from imageio import imread, imwrite
 from io import BytesIO
 
-from .wrangle import cat_to_rgba, add_black_bg, cat_to_display
+from .wrangle import cat_to_rgba, add_black_bg, cat_to_display_batch
+from .embedstore import EmbeddingWriter, EmbeddingStore, is_store, tile_name, compact
+from .manifest import Manifest, MANIFEST_FILE
+from .shards import open_tiles, array_to_png
+from .shift import TileMosaic
 
 def read_img_bytes(path):
     with open(path, 'rb') as f:
@@ -32,10 +40,21 @@ def get_model(model_path):
     return g, sess
 
 
+def model_version(model_path):
+    """Short hash of the exported graph and variables index, changes whenever the model is re-exported"""
+    h = hashlib.sha1()
+    for filename in ('saved_model.pb', os.path.join('variables', 'variables.index')):
+        path = os.path.join(model_path, filename)
+        if os.path.exists(path):
+            h.update(read_img_bytes(path))
+    return h.hexdigest()[:12]
+
+
 class Encoder:
 
     def __init__(self, model_path):
         self.g, self.sess = get_model(model_path)
+        self.version = model_version(model_path)
 
     def encode(self, img):
         with self.g.as_default():
@@ -47,6 +66,22 @@ class Encoder:
             })
             return res
 
+    def encode_batch(self, imgs):
+        """Encode a sequence of PNG byte strings in a single session call, returns an (N, D) array"""
+        imgs = tuple(imgs)
+        with self.g.as_default():
+            tf.set_random_seed(1337)
+            image = self.g.get_tensor_by_name("input:0")
+            model = self.g.get_tensor_by_name('add:0')
+            res = self.sess.run(model, {
+                image: imgs
+            })
+        res = np.asarray(res)
+        if len(res) != len(imgs):
+            # the exported graph only encodes a single image per call, encode one by one
+            return np.vstack([np.asarray(self.encode(img)).reshape(1, -1) for img in imgs])
+        return res
+
 
 class Decoder:
 
@@ -63,19 +98,223 @@ class Decoder:
             })
             return get_img_from_base64(res)
 
+    def decode_batch(self, embs):
+        """Decode an (N, D) array of embeddings in a single session call, returns a list of N images"""
+        embs = np.asarray(embs).reshape((len(embs), -1))
+        with self.g.as_default():
+            tf.set_random_seed(1337)
+            embeddings = self.g.get_tensor_by_name("input:0")
+            model = self.g.get_tensor_by_name('EncodeBase64:0')
+            res = self.sess.run(model, {
+                embeddings: embs
+            })
+        res = np.ravel(res)
+        if len(res) != len(embs):
+            # the exported graph only encodes a single image per call, decode one by one
+            return [self.decode(emb.reshape(1, -1)) for emb in embs]
+        return [get_img_from_base64(b64) for b64 in res]
 
-def use_model(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, result_colors, reverse=False):
 
-    filenames = [filename for filename in os.listdir(input_dir) if filename.endswith('.png')]
+def batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
 
-    for filename in filenames:
-        img = read_img_bytes(os.path.join(input_dir, filename))
-        res = encoder.encode(img)
+
+def select_tiles(encoder, tiles, embed_output_dir, incremental=False, tile_filter=None):
+    """List the tiles to process, in incremental mode only those not yet in the manifest of embed_output_dir.
+    tile_filter, e.g. a stats.coverage_filter, drops tiles not worth encoding
+    """
+    filenames = tiles.filenames()
+    if tile_filter is not None:
+        filenames = tile_filter(filenames)
+    if not incremental:
+        return filenames, None
+
+    manifest = Manifest(os.path.join(embed_output_dir, MANIFEST_FILE), encoder.version)
+    pending = manifest.pending(filenames, tiles.stat)
+    print('{} of {} tiles are new or changed since the last run'.format(len(pending), len(filenames)))
+    return pending, manifest
+
+
+def open_embed_output(embed_output_dir, embed_store=False, manifest=None):
+    if embed_store:
+        # tiles only go into the manifest once their chunk is actually written to the store
+        return EmbeddingWriter(embed_output_dir, on_flush=manifest.record if manifest is not None else None)
+    return embed_output_dir
+
+
+def close_embed_output(embed_output):
+    if isinstance(embed_output, EmbeddingWriter):
+        embed_output.close()
+        dropped = compact(embed_output.store_dir)
+        if dropped:
+            print('dropped {} outdated rows of re-encoded tiles from the store'.format(dropped))
+
+
+def save_embeddings(embed_output, filenames, embs, manifest=None):
+    """Save embeddings either to an EmbeddingWriter or as one .npy file per tile in a directory"""
+    if isinstance(embed_output, EmbeddingWriter):
+        embed_output.append(filenames, embs)
+        return
+    embed_output_dir = embed_output
+    for filename, emb in zip(filenames, embs):
         vec_filename = filename[:-4] + '.npy'
-        np.save(os.path.join(embed_output_dir, vec_filename), res)
-        im = decoder.decode(res)
-        imwrite(os.path.join(reconstruction_output_dir, filename), cat_to_display(im, result_colors, reverse))
+        np.save(os.path.join(embed_output_dir, vec_filename), emb.reshape(1, -1))
+    if manifest is not None:
+        manifest.record(filenames)
+
+
+RECONSTRUCTION_MODES = ('all', 'none', 'every', 'sample')
+
+
+def select_reconstructions(filenames, mode='all', n=1, seed=1234):
+    """Set of filenames to decode and write reconstructions for.
+
+    'all' and 'none' do what they say, 'every' takes every nth tile and 'sample' a fixed random subset of n tiles
+    """
+    if mode == 'all':
+        return set(filenames)
+    elif mode == 'none':
+        return set()
+    elif mode == 'every':
+        return set(filenames[::n])
+    elif mode == 'sample':
+        return set(random.Random(seed).sample(sorted(filenames), min(n, len(filenames))))
+    else:
+        raise ValueError('invalid reconstruction mode')
+
+
+def decode_selected(decoder, filenames, embs, selected):
+    """Decode only the embeddings whose filename is in selected, returns the decoded filenames and images"""
+    indices = [i for i, filename in enumerate(filenames) if filename in selected]
+    if not indices:
+        return [], []
+    return [filenames[i] for i in indices], decoder.decode_batch(np.asarray(embs)[indices])
+
+
+def save_reconstructions(reconstruction_output_dir, filenames, ims, result_colors, reverse=False):
+    if not filenames:
+        return
+    for filename, arr in zip(filenames, cat_to_display_batch(ims, result_colors, reverse)):
+        imwrite(os.path.join(reconstruction_output_dir, filename), arr)
+
+
+def print_throughput(n, start, batch_size):
+    elapsed = time.time() - start
+    print('elapsed {}s, {:.1f} tiles/s with batch size {}'.format(elapsed, n / elapsed if elapsed > 0 else 0, batch_size))
+
+
+def use_model(encoder, decoder, input_dir, embed_output_dir, reconstruction_output_dir, result_colors, reverse=False, batch_size=64,
+              embed_store=False, incremental=False, reconstructions='all', reconstruction_n=1, tile_filter=None):
+
+    tiles = open_tiles(input_dir)
+    filenames, manifest = select_tiles(encoder, tiles, embed_output_dir, incremental, tile_filter)
+    n = len(filenames)
+    selected = select_reconstructions(filenames, reconstructions, reconstruction_n)
+
+    embed_output = open_embed_output(embed_output_dir, embed_store, manifest)
+
+    start = time.time()
+    done = 0
+    for batch in batches(filenames, batch_size):
+        imgs = [tiles.read_png(filename) for filename in batch]
+        res = encoder.encode_batch(imgs)
+        save_embeddings(embed_output, batch, res, manifest)
+        recon_filenames, ims = decode_selected(decoder, batch, res, selected)
+        save_reconstructions(reconstruction_output_dir, recon_filenames, ims, result_colors, reverse)
+        done += len(batch)
+        elapsed = time.time() - start
+        print('\rProcessed {} of {} tiles ({:.1f} tiles/s)'.format(done, n, done / elapsed if elapsed > 0 else 0), end='')
+    print()
+
+    close_embed_output(embed_output)
+
+    print_throughput(n, start, batch_size)
+
+
+def reconstruct(decoder, embeddings_dir, names, reconstruction_output_dir, result_colors, reverse=False, batch_size=64):
+    """Decode and write reconstructions for the given tile names from an embedding store or per-tile .npy directory"""
+    names = [tile_name(name) for name in names]
+    store = EmbeddingStore(embeddings_dir) if is_store(embeddings_dir) else None
+
+    start = time.time()
+    for batch in batches(names, batch_size):
+        if store is not None:
+            embs = store.vectors[store.rows(batch)]
+        else:
+            embs = np.vstack([np.load(os.path.join(embeddings_dir, name + '.npy')).reshape(1, -1) for name in batch])
+        ims = decoder.decode_batch(embs)
+        save_reconstructions(reconstruction_output_dir, [name + '.png' for name in batch], ims, result_colors, reverse)
+
+    print_throughput(len(names), start, batch_size)
+
+
+def window_positions(start, end, stride):
+    """Fractional tile coordinates from start to end inclusive, stride tiles apart"""
+    return start + stride * np.arange(int(np.floor((end - start) / stride + 1e-9)) + 1)
+
+
+def embed_windows(encoder, mosaic, zoom, col_min, row_min, col_max, row_max, stride=0.5, batch_size=64):
+    """Dense (rows, cols, D) raster of the embeddings of tile sized windows slid over the tiles
+    col_min..col_max, row_min..row_max of mosaic, a shift.TileMosaic, stride tiles apart.
+
+    Windows are read row by row, with the mosaic cache holding enough tiles for the tiles shared by
+    consecutive rows of windows to be read only once. Windows not covering any tile are left as nan
+    """
+    cols = window_positions(col_min, col_max, stride)
+    rows = window_positions(row_min, row_max, stride)
+    mosaic.cache_size = max(mosaic.cache_size, 2 * (int(np.ceil(col_max - col_min)) + 3))
+
+    raster = None
+    positions, imgs = [], []
+
+    def encode_pending():
+        nonlocal raster
+        embs = np.asarray(encoder.encode_batch(imgs)).reshape(len(imgs), -1)
+        if raster is None:
+            raster = np.full((len(rows), len(cols), embs.shape[1]), np.nan, dtype=np.float32)
+        for (i, j), emb in zip(positions, embs):
+            raster[i, j] = emb
+        del positions[:], imgs[:]
+
+    start = time.time()
+    for i, row in enumerate(rows):
+        for j, col in enumerate(cols):
+            window = mosaic.window(zoom, col, row)
+            if window is None:
+                continue
+            positions.append((i, j))
+            imgs.append(array_to_png(window))
+            if len(imgs) == batch_size:
+                encode_pending()
+        print('\rEncoded {} of {} rows of {} windows'.format(i + 1, len(rows), len(cols)), end='')
+    if imgs:
+        encode_pending()
+    print()
+    print_throughput(len(rows) * len(cols), start, batch_size)
+    print('{} tile reads, {} from the cache'.format(mosaic.hits + mosaic.misses, mosaic.hits))
+    return raster
+
+
+def save_window_raster(output_dir, region_name, raster, zoom, col_min, row_min, stride):
+    """Write a raster as <region_name>.npy, with its grid origin and stride in <region_name>.json"""
+    path = os.path.join(output_dir, region_name + '.npy')
+    np.save(path + '.tmp.npy', raster)
+    os.replace(path + '.tmp.npy', path)
+    with open(os.path.join(output_dir, region_name + '.json'), 'w') as f:
+        json.dump({'zoom': zoom, 'col': col_min, 'row': row_min, 'stride': stride, 'shape': list(raster.shape)}, f)
+
 
+def use_model_windows(encoder, input_dir, embed_output_dir, regions, stride=0.5, batch_size=64):
+    """Sliding-window embedding rasters, one per (name, zoom, col_min, row_min, col_max, row_max) region"""
+    mosaic = TileMosaic(input_dir)
+    for region_name, zoom, col_min, row_min, col_max, row_max in regions:
+        print('Region {}'.format(region_name))
+        raster = embed_windows(encoder, mosaic, zoom, col_min, row_min, col_max, row_max, stride, batch_size)
+        if raster is None:
+            print('no tiles in region {}'.format(region_name))
+            continue
+        save_window_raster(embed_output_dir, region_name, raster, zoom, col_min, row_min, stride)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,16 @@
 import os
+import time
 import argparse
-from functools import reduce
+from functools import reduce, partial
+from multiprocessing import Pool
 
 import numpy as np
 from imageio import imread, imwrite
 from PIL import Image
 
+from .shards import ShardReader, is_shard_dir
+from .stats import coverage_filter
+
 standard_cat_colors = ((0, 0, 1), (0, 1, 0), (1, 1, 1), (1, 0, 0))
 
 def imgs_to_ndarr(*img_defs):
@@ -13,12 +18,120 @@ def imgs_to_ndarr(*img_defs):
     return np.stack(img_channels, axis=2)
 
 
+_shard_readers = {}
+
+def _shards(directory):
+    # one reader per shard set and process
+    if directory not in _shard_readers:
+        _shard_readers[directory] = ShardReader(directory)
+    return _shard_readers[directory]
+
+
+def list_tile_files(directory):
+    if is_shard_dir(directory):
+        return _shards(directory).filenames()
+    return os.listdir(directory)
+
+
+def read_tile(directory, filename):
+    """Read a tile from a directory of PNGs or from a shard set"""
+    if is_shard_dir(directory):
+        return _shards(directory).read(filename)
+    return imread(os.path.join(directory, filename))
+
+
+def tile_mtime(directory, filename):
+    if is_shard_dir(directory):
+        return _shards(directory).stat(filename)[1] / 1e9
+    return os.path.getmtime(os.path.join(directory, filename))
+
+
 def split_to_cat(tile_name, root_path, channel_defs):
-    img_defs = [(imread(os.path.join(root_path, type_name, tile_name)), channel) for type_name, channel in channel_defs]
+    img_defs = [(read_tile(os.path.join(root_path, type_name), tile_name), channel) for type_name, channel in channel_defs]
     return imgs_to_ndarr(*img_defs)
 
 
+def _div255(a):
+    return ((a >> 8) + a) >> 8
+
+
+def _blend(dst, src):
+    # same 7 bit fixed point arithmetic as PIL's libImaging/AlphaComposite.c, on 1-D channel planes
+    dst = [plane.astype(np.uint32) for plane in dst]
+    src = [plane.astype(np.uint32) for plane in src]
+    src_alpha = src[3]
+    out_alpha255 = src_alpha * 255 + dst[3] * (255 - src_alpha)
+    coef1 = src_alpha * (255 * 255 << 7) // out_alpha255
+    coef2 = (255 << 7) - coef1
+    rgb = [_div255(s * coef1 + d * coef2 + (0x80 << 7)) >> 7 for s, d in zip(src[:3], dst[:3])]
+    return rgb + [_div255(out_alpha255 + 0x80)]
+
+
+def _composite_planes(dst, src):
+    # dst and src are lists of 4 flat, contiguous uint8 channel planes
+    src_alpha = src[3]
+    opaque = src_alpha == 255
+    # fully transparent source pixels keep dst and opaque ones replace it exactly,
+    # so the arithmetic is only needed for the (few, anti-aliased) partially transparent pixels
+    # branch-free select, much faster than np.where on the noisy masks of real tiles
+    select = opaque.view(np.uint8) * np.uint8(255)
+    out = [d ^ ((d ^ s) & select) for s, d in zip(src, dst)]
+    translucent = np.flatnonzero((src_alpha != 0) & ~opaque)
+    if len(translucent):
+        blended = _blend([d[translucent] for d in dst], [s[translucent] for s in src])
+        for o, values in zip(out, blended):
+            o[translucent] = values
+    return out
+
+
+def _to_planes(arr):
+    return [np.ascontiguousarray(arr[..., i]).ravel() for i in range(arr.shape[-1])]
+
+
+def _from_planes(planes, shape):
+    return np.stack(planes, axis=-1).reshape(shape + (len(planes),))
+
+
+def alpha_composite(dst, src):
+    """NumPy port of PIL's Image.alpha_composite for uint8 RGBA arrays of any leading shape, bit-exact with PIL"""
+    return _from_planes(_composite_planes(_to_planes(dst), _to_planes(src)), src.shape[:-1])
+
+
+def _cat_to_planes(arr, channel_defs, reverse=False):
+    layers = list(zip(_to_planes(arr), channel_defs))
+    planes = None
+    for layer, color_mult in reversed(layers) if reverse else layers:
+        layer_planes = [np.multiply(layer, np.uint8(mult)) for mult in color_mult] + [layer]
+        planes = layer_planes if planes is None else _composite_planes(planes, layer_planes)
+    return planes
+
+
+def _batch_shape(arr):
+    arr = np.asarray(arr)
+    return arr.reshape(arr.shape[:3] + (-1,))
+
+
+def _map_chunks(fn, arr, chunk_size):
+    # a handful of tiles at a time keeps the intermediate planes in cache
+    out = np.empty(arr.shape[:3] + (4,), dtype=np.uint8)
+    for i in range(0, len(arr), chunk_size):
+        chunk = arr[i:i + chunk_size]
+        out[i:i + chunk_size] = _from_planes(fn(chunk), chunk.shape[:3])
+    return out
+
+
+def cat_to_rgba_batch(arr, channel_defs, reverse=False, chunk_size=16):
+    """Colorize and composite a whole (N, H, W, C) batch of categorical tiles, returns (N, H, W, 4)"""
+    return _map_chunks(lambda chunk: _cat_to_planes(chunk, channel_defs, reverse), _batch_shape(arr), chunk_size)
+
+
 def cat_to_rgba(arr, channel_defs, reverse=False):
+    arr = arr.reshape((arr.shape[0], arr.shape[1], -1))
+    return cat_to_rgba_batch(arr[np.newaxis], channel_defs, reverse)[0]
+
+
+def cat_to_rgba_pil(arr, channel_defs, reverse=False):
+    """Reference implementation of cat_to_rgba compositing the layers with PIL, one tile at a time"""
     arr = arr.reshape((arr.shape[0], arr.shape[1], -1))
     channel_layers = np.dsplit(arr, arr.shape[2])
     zipped_data = zip(channel_layers, channel_defs)
@@ -38,7 +151,26 @@ def alpha_to_black(arr):
     return arr[:,:,0:3]
 
 
+def _add_black_bg_planes(planes):
+    bg = [np.zeros_like(planes[3]) for _ in range(3)] + [np.full_like(planes[3], 255)]
+    return _composite_planes(bg, planes)
+
+
+def add_black_bg_batch(arr):
+    if arr.shape[-1] != 4:
+        raise ValueError('Original image does not have an alpha channel, there\'s no way to add a background')
+
+    return _from_planes(_add_black_bg_planes(_to_planes(arr)), arr.shape[:-1])
+
+
 def add_black_bg(arr):
+    if arr.shape[2] != 4:
+        raise ValueError('Original image does not have an alpha channel, there\'s no way to add a background')
+
+    return add_black_bg_batch(arr)
+
+
+def add_black_bg_pil(arr):
     if arr.shape[2] != 4:
         raise ValueError('Original image does not have an alpha channel, there\'s no way to add a background')
     img = Image.fromarray(arr, 'RGBA')
@@ -47,6 +179,14 @@ def add_black_bg(arr):
     return np.array(Image.alpha_composite(bg, img))
 
 
+def cat_to_display_batch(arrs, colors=standard_cat_colors, reverse=False, chunk_size=16):
+    """cat_to_display for a list of images or an (N, H, W, C) array"""
+    if not isinstance(arrs, np.ndarray):
+        arrs = np.stack([np.array(arr) for arr in arrs])
+
+    return _map_chunks(lambda chunk: _add_black_bg_planes(_cat_to_planes(chunk, colors, reverse)), _batch_shape(arrs), chunk_size)
+
+
 def cat_to_display(arr, colors=standard_cat_colors, reverse=False):
     if isinstance(arr, Image.Image):
         arr = np.array(arr)
@@ -54,6 +194,13 @@ def cat_to_display(arr, colors=standard_cat_colors, reverse=False):
     return add_black_bg(cat_to_rgba(arr, colors, reverse))
 
 
+def cat_to_display_pil(arr, colors=standard_cat_colors, reverse=False):
+    if isinstance(arr, Image.Image):
+        arr = np.array(arr)
+
+    return add_black_bg_pil(cat_to_rgba_pil(arr, colors, reverse))
+
+
 def save_img(arr, path):
     if isisntance(arr, Image.Image):
         arr = np.array(arr)
@@ -73,6 +220,63 @@ def test():
     imwrite('test_res_black.png', alpha_to_black(converted))
 
 
+def tile_sources(mode, input_directory, types=None):
+    if mode == 'split-cat':
+        return [os.path.join(input_directory, t) for t in types]
+    return [input_directory]
+
+
+def is_up_to_date(dest, filename, source_directories):
+    """Output exists and is newer than all of its inputs"""
+    try:
+        dest_mtime = os.path.getmtime(dest)
+    except OSError:
+        return False
+    return all(tile_mtime(directory, filename) <= dest_mtime for directory in source_directories)
+
+
+def process_tile(filename, mode, input_directory, output_directory, types=None, channels=None, colors=standard_cat_colors, force=False):
+    """Convert a single tile, returns False if it was skipped because the output is up to date"""
+    dest = os.path.join(output_directory, filename)
+    if not force and is_up_to_date(dest, filename, tile_sources(mode, input_directory, types)):
+        return False
+
+    if mode == 'cat-rgb':
+        arr = read_tile(input_directory, filename)
+        imwrite(dest, cat_to_display(arr, colors))
+    elif mode == 'split-cat':
+        imwrite(dest, split_to_cat(filename, input_directory, list(zip(types, channels))))
+    return True
+
+
+def process_tiles(filenames, mode, input_directory, output_directory, types=None, channels=None, colors=standard_cat_colors,
+                  workers=1, chunk_size=64, force=False):
+    """Convert all tiles, spreading chunks of chunk_size tiles over a pool of worker processes"""
+    fn = partial(process_tile, mode=mode, input_directory=input_directory, output_directory=output_directory,
+                 types=types, channels=channels, colors=colors, force=force)
+    n = len(filenames)
+
+    start = time.time()
+    processed = 0
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(fn, filenames, chunk_size) if pool is not None else map(fn, filenames)
+        print() # print an empty new line
+        for i, result in enumerate(results):
+            processed += result
+            if i % chunk_size == 0:
+                print('\rProcessing tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print()
+
+    elapsed = time.time() - start
+    print('{} tiles processed, {} up to date and skipped, in {:.1f}s ({:.1f} tiles/s with {} workers)'.format(
+        processed, n - processed, elapsed, processed / elapsed if elapsed > 0 else 0, workers))
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -83,16 +287,23 @@ def main():
     parser.add_argument('-x', '--channels', type=int, nargs='*')
     parser.add_argument('-c', '--colors', nargs='*', default=["0,0,1", "0,1,0", "1,1,1", "1,0,0"])
     parser.add_argument('-m', '--mode', choices=['split-cat', 'cat-rgb'])
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('-f', '--force', action='store_true', default=False)
+    parser.add_argument('--stats', help='tile statistics index, from python -m tileutils.stats, (re)built first if missing or out of date')
+    parser.add_argument('--min-coverage', type=float)
+    parser.add_argument('--max-coverage', type=float, help='no upper bound by default, summed coverage can exceed 1')
+    parser.add_argument('--coverage-channels', type=int, nargs='*')
     
 
     args = parser.parse_args()
 
     if args.mode == 'split-cat' and len(args.types) != len(args.channels):
         raise ValueError('Need the same number of channel definitions as types')
+    if (args.min_coverage is not None or args.max_coverage is not None) and not args.stats:
+        raise ValueError('Coverage thresholds need a tile statistics index, pass --stats')
 
-    color_tuples = [int(x) for c in args.colors for x in c.split(',') ]
-
-    directories = [os.path.join(args.input_directory, t) for t in args.types]
+    color_tuples = [tuple(int(x) for x in c.split(',')) for c in args.colors]
 
     try:
         os.makedirs(args.output_directory)
@@ -101,25 +312,20 @@ def main():
 
     if args.mode == 'split-cat':
         # assume all type directories contain the same list of files
-        filenames = os.listdir(directories[0])
+        filenames = list_tile_files(os.path.join(args.input_directory, args.types[0]))
     elif args.mode == 'cat-rgb':
-        filenames = os.listdir(args.input_directory)
-    n = len(filenames)
+        filenames = list_tile_files(args.input_directory)
 
-    print() # print an empty new line
-    for i, filename in enumerate(filenames):
-        print('\rProcessing tiles {} of {} ({}% complete)'.format(i, n, int(i * 100 / n)), end='')
-        dest = os.path.join(args.output_directory, filename)
+    if args.stats:
+        # in split-cat mode the coverage is that of the categorical tiles about to be written, not of their type layers
+        channel_defs = list(zip(args.types, args.channels)) if args.mode == 'split-cat' else None
+        tile_filter = coverage_filter(args.stats, args.input_directory, args.min_coverage, args.max_coverage, args.coverage_channels,
+                                      args.workers, channel_defs)
+        filenames = tile_filter(filenames)
 
-        if args.mode == 'cat-rgb':
-            orig = os.path.join(args.input_directory, filename)
-            arr = imread(orig)
-            imwrite(dest, cat_to_display(arr, color_tuples))
-            pass
-        elif args.mode == 'split-cat':
-            type_files = [os.path.join(d, filename) for d in directories]
-            imwrite(dest, split_to_cat(filename, args.input_directory, zip(args.types, args.channels)))
+    process_tiles(filenames, args.mode, args.input_directory, args.output_directory, args.types, args.channels, color_tuples,
+                  args.workers, args.chunk_size, args.force)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()